@@ -0,0 +1,85 @@
+"""
+Compares the approximate pvalues (--pvalue-method approximate) with the permutation pvalues of the statistical
+analysis on the test fixtures and reports their agreement and run times.
+
+    python benchmarks/approximate_pvalues.py --data test --iterations 1000
+    python benchmarks/approximate_pvalues.py --data test --cells 2000
+
+With --cells, the fixture cells are resampled (keeping their cell types, with random dropout and noise) to check the
+approximation with bigger clusters.
+"""
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from cellphonedb.src.app import cpdb_app
+from cellphonedb.src.app.cellphonedb_app import data_test_dir
+from cellphonedb.utils import utils
+
+
+def resample_cells(meta: pd.DataFrame, counts: pd.DataFrame, cells_number: int, seed: int) -> (pd.DataFrame,
+                                                                                               pd.DataFrame):
+    random_generator = np.random.default_rng(seed)
+    cells = random_generator.integers(0, len(meta), cells_number)
+
+    dropout = random_generator.random((len(counts), cells_number)) < 0.5
+    noise = random_generator.gamma(2, 0.5, (len(counts), cells_number))
+    cells_names = ['cell_{}'.format(cell) for cell in range(cells_number)]
+
+    resampled_counts = pd.DataFrame(counts[meta.iloc[cells, 0].astype(str)].values * dropout * noise,
+                                    index=counts.index, columns=cells_names)
+    resampled_meta = pd.DataFrame({'cell': cells_names, 'cell_type': meta.iloc[cells, 1].values})
+
+    return resampled_meta, resampled_counts
+
+
+@click.command()
+@click.option('--data', default='test', help='Test fixture (hi_<data>_meta.txt and hi_<data>_counts.txt) [test]')
+@click.option('--iterations', default=1000, type=int, help='Permutation iterations [1000]')
+@click.option('--threads', default=4, type=int, help='Permutation threads [4]')
+@click.option('--cells', default=0, type=int, help='Resample the fixture to this number of cells, 0 to keep it [0]')
+@click.option('--pvalue', default=0.05, type=float, help='Pvalue threshold of the significance agreement [0.05]')
+@click.option('--seed', default=0, type=int, help='Permutations and resampling seed [0]')
+def benchmark(data: str, iterations: int, threads: int, cells: int, pvalue: float, seed: int) -> None:
+    meta = utils.read_data_table_from_file('{}/hi_{}_meta.txt'.format(data_test_dir, data))
+    counts = utils.read_data_table_from_file('{}/hi_{}_counts.txt'.format(data_test_dir, data),
+                                             index_column_first=True)
+
+    if cells:
+        meta, counts = resample_cells(meta, counts, cells, seed)
+
+    method = cpdb_app.create_app(verbose=False).method
+
+    def launch(pvalue_method: str) -> (pd.DataFrame, float):
+        start = time.perf_counter()
+        pvalues, _, _, _ = method.cpdb_statistical_analysis_launcher(meta.copy(), counts, 'ensembl', iterations, 0.1,
+                                                                     threads, seed, 3, pvalue,
+                                                                     pvalue_method=pvalue_method)
+        return pvalues, time.perf_counter() - start
+
+    permutation_pvalues, permutation_seconds = launch('permutation')
+    approximate_pvalues, approximate_seconds = launch('approximate')
+
+    cluster_interactions = [column for column in permutation_pvalues.columns if '|' in column]
+    permutation_values = permutation_pvalues[cluster_interactions].values.ravel()
+    approximate_values = approximate_pvalues[cluster_interactions].values.ravel()
+
+    tested = permutation_values < 1
+    permutation_tested = pd.Series(permutation_values[tested])
+    approximate_tested = pd.Series(approximate_values[tested])
+
+    click.echo('Cells: {}'.format(len(meta)))
+    click.echo('Tested pvalues: {}'.format(np.count_nonzero(tested)))
+    click.echo('Spearman correlation: {:.3f}'.format(permutation_tested.corr(approximate_tested, method='spearman')))
+    click.echo('Mean absolute error: {:.4f}'.format((permutation_tested - approximate_tested).abs().mean()))
+    click.echo('Significance agreement at {}: {:.3f} ({} permutation, {} approximate significant)'.format(
+        pvalue, ((permutation_tested <= pvalue) == (approximate_tested <= pvalue)).mean(),
+        (permutation_tested <= pvalue).sum(), (approximate_tested <= pvalue).sum()))
+    click.echo('Time: {:.2f}s with {} permutations, {:.2f}s approximate'.format(permutation_seconds, iterations,
+                                                                                approximate_seconds))
+
+
+if __name__ == '__main__':
+    benchmark()
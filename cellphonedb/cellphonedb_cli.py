@@ -37,6 +37,8 @@ def plot():
 
 method.add_command(method_terminal_commands.statistical_analysis)
 method.add_command(method_terminal_commands.analysis)
+method.add_command(method_terminal_commands.summarize)
+method.add_command(method_terminal_commands.summary_analysis)
 query.add_command(query_terminal_commands.find_interactions_by_element)
 query.add_command(query_terminal_commands.get_interaction_gene)
 
@@ -9,7 +9,10 @@ from cellphonedb.src.api_endpoints.terminal_api.util.choose_database import choo
 from cellphonedb.src.app import cpdb_app
 from cellphonedb.src.app.app_logger import app_logger
 from cellphonedb.src.core.exceptions.AllCountsFilteredException import AllCountsFilteredException
+from cellphonedb.src.core.exceptions.CheckpointException import CheckpointException
+from cellphonedb.src.core.exceptions.ClusterPairsException import ClusterPairsException
 from cellphonedb.src.core.exceptions.EmptyResultException import EmptyResultException
+from cellphonedb.src.core.exceptions.PvalueMethodException import PvalueMethodException
 from cellphonedb.src.core.exceptions.ThresholdValueException import ThresholdValueException
 from cellphonedb.src.core.utils.subsampler import Subsampler
 from cellphonedb.src.exceptions.ParseCountsException import ParseCountsException
@@ -59,10 +62,8 @@ def subsampling_options(f: Callable) -> Callable:
     return f
 
 
-def common_options(f: Callable) -> Callable:
+def analysis_options(f: Callable) -> Callable:
     options = [
-        click.argument('meta-filename'),
-        click.argument('counts-filename'),
         click.option('--counts-data', type=click.Choice(['ensembl', 'gene_name', 'hgnc_symbol']), default='ensembl'),
         click.option('--project-name', default='', type=str,
                      help='Name of the project. It creates a subfolder in output folder'),
@@ -70,7 +71,9 @@ def common_options(f: Callable) -> Callable:
         click.option('--result-precision', default='3', type=int, help='Number of decimal digits in results [3]'),
         click.option('--output-path', default='', type=str,
                      help='Directory where the results will be allocated (the directory must exist) [out]'),
-        click.option('--output-format', type=click.Choice(['txt', 'csv', 'tsv', 'tab'])),
+        click.option('--output-format', type=click.Choice(['txt', 'csv', 'tsv', 'tab', 'parquet', 'feather'])),
+        click.option('--output-compression', type=click.Choice(['snappy', 'gzip', 'brotli']),
+                     help='Compression of parquet result files [none]'),
         click.option('--means-result-name', default='means', type=str, help='Means result namefile [means]'),
         click.option('--significant-means-result-name', default='significant_means', type=str,
                      help='Significant result namefile [significant_means]'),
@@ -78,6 +81,29 @@ def common_options(f: Callable) -> Callable:
                      help='Deconvoluted result namefile [deconvoluted]'),
         click.option('--verbose/--quiet', default=True, help='Print or hide cellphonedb logs [verbose]'),
         click.option('--database', default='latest', callback=choose_database),
+        click.option('--cell-types', type=click.Path(exists=True, file_okay=True, dir_okay=False),
+                     help='File with the cell types to analyse, one per line [all]'),
+        click.option('--cluster-pairs', type=click.Path(exists=True, file_okay=True, dir_okay=False),
+                     help='File with the sender|receiver cell type pairs to analyse, one per line [all]'),
+        click.option('--interactions', type=click.Path(exists=True, file_okay=True, dir_okay=False),
+                     help='File with the interaction ids, partner names or genes to analyse, one per line [all]'),
+        click.option('--interaction-class', type=click.Choice(['secreted', 'integrin', 'receptor']), multiple=True,
+                     help='Analyse only interactions with a partner of this class. Can be repeated [all]'),
+        click.option('--profile', is_flag=True,
+                     help='Write the time, CPU and memory used by each stage to profile.json in the output path'),
+    ]
+
+    for option in reversed(options):
+        f = option(f)
+
+    return f
+
+
+def common_options(f: Callable) -> Callable:
+    options = [
+        click.argument('meta-filename'),
+        click.argument('counts-filename'),
+        analysis_options,
         subsampling_options
     ]
 
@@ -94,6 +120,18 @@ def common_options(f: Callable) -> Callable:
 @click.option('--pvalues-result-name', default='pvalues', type=str, help='Pvalues result namefile [pvalues]')
 @click.option('--iterations', default=1000, type=int, help='Number of pvalues analysis iterations [1000]')
 @click.option('--threads', default=4, type=int, help='Max of threads to process the data [4]')
+@click.option('--max-exceedances', default=0, type=int,
+              help='Stop shuffling a pvalue once this many shuffled means are bigger than the real one. '
+                   '0 to run all the iterations [0]')
+@click.option('--checkpoint-dir', default=None, type=click.Path(file_okay=False, dir_okay=True),
+              help='Directory where the shuffling state is saved periodically [none]')
+@click.option('--checkpoint-iterations', default=1000, type=int,
+              help='Number of iterations between checkpoints [1000]')
+@click.option('--resume', is_flag=True,
+              help='Continue the shuffling from the checkpoint saved in --checkpoint-dir')
+@click.option('--pvalue-method', default='permutation', type=click.Choice(['permutation', 'approximate']),
+              help='Calculate the pvalues shuffling the cells clusters or approximate them from the counts moments, '
+                   'without shuffling, for fast screening runs [permutation]')
 def statistical_analysis(meta_filename: str,
                          counts_filename: str,
                          counts_data: str,
@@ -102,11 +140,17 @@ def statistical_analysis(meta_filename: str,
                          result_precision: int,
                          output_path: str,
                          output_format: str,
+                         output_compression: Optional[str],
                          means_result_name: str,
                          significant_means_result_name: str,
                          deconvoluted_result_name: str,
                          verbose: bool,
                          database: Optional[str],
+                         cell_types: Optional[str],
+                         cluster_pairs: Optional[str],
+                         interactions: Optional[str],
+                         interaction_class: tuple,
+                         profile: bool,
                          subsampling: bool,
                          subsampling_log: bool,
                          subsampling_num_pc: int,
@@ -115,7 +159,12 @@ def statistical_analysis(meta_filename: str,
                          pvalue: float,
                          pvalues_result_name: str,
                          iterations: int,
-                         threads: int
+                         threads: int,
+                         max_exceedances: int,
+                         checkpoint_dir: Optional[str],
+                         checkpoint_iterations: int,
+                         resume: bool,
+                         pvalue_method: str
                          ) -> None:
     try:
 
@@ -142,9 +191,20 @@ def statistical_analysis(meta_filename: str,
                                                             result_precision,
                                                             pvalue,
                                                             subsampler,
+                                                            output_compression,
+                                                            max_exceedances,
+                                                            cell_types,
+                                                            cluster_pairs,
+                                                            interactions,
+                                                            interaction_class,
+                                                            checkpoint_dir,
+                                                            checkpoint_iterations,
+                                                            resume,
+                                                            profile,
+                                                            pvalue_method,
                                                             )
     except (ReadFileException, ParseMetaException, ParseCountsException, ThresholdValueException,
-            AllCountsFilteredException) as e:
+            AllCountsFilteredException, ClusterPairsException, CheckpointException, PvalueMethodException) as e:
         app_logger.error(str(e) +
                          (':' if (hasattr(e, 'description') and e.description) or (
                                  hasattr(e, 'hint') and e.hint) else '') +
@@ -175,11 +235,17 @@ def analysis(meta_filename: str,
              result_precision: int,
              output_path: str,
              output_format: str,
+             output_compression: Optional[str],
              means_result_name: str,
              significant_means_result_name: str,
              deconvoluted_result_name: str,
              verbose: bool,
              database: Optional[str],
+             cell_types: Optional[str],
+             cluster_pairs: Optional[str],
+             interactions: Optional[str],
+             interaction_class: tuple,
+             profile: bool,
              subsampling: bool,
              subsampling_log: bool,
              subsampling_num_pc: int,
@@ -205,9 +271,128 @@ def analysis(meta_filename: str,
                                                                                                deconvoluted_result_name,
                                                                                                result_precision,
                                                                                                subsampler,
+                                                                                               output_compression,
+                                                                                               cell_types,
+                                                                                               cluster_pairs,
+                                                                                               interactions,
+                                                                                               interaction_class,
+                                                                                               profile,
                                                                                                )
     except (ReadFileException, ParseMetaException, ParseCountsException, ThresholdValueException,
-            AllCountsFilteredException) as e:
+            AllCountsFilteredException, ClusterPairsException) as e:
+        app_logger.error(str(e) +
+                         (':' if (hasattr(e, 'description') and e.description) or (
+                                 hasattr(e, 'hint') and e.hint) else '') +
+                         (' {}.'.format(e.description) if hasattr(e, 'description') and e.description else '') +
+                         (' {}.'.format(e.hint) if hasattr(e, 'hint') and e.hint else '')
+                         )
+
+    except EmptyResultException as e:
+        app_logger.warning(str(e) +
+                           (':' if (hasattr(e, 'description') and e.description) or (
+                                   hasattr(e, 'hint') and e.hint) else '') +
+                           (' {}.'.format(e.description) if hasattr(e, 'description') and e.description else '') +
+                           (' {}.'.format(e.hint) if hasattr(e, 'hint') and e.hint else '')
+                           )
+    except:
+        app_logger.error('Unexpected error')
+
+        if verbose:
+            traceback.print_exc(file=sys.stdout)
+
+
+@click.command()
+@click.argument('meta-filename')
+@click.argument('counts-filename')
+@click.option('--counts-data', type=click.Choice(['ensembl', 'gene_name', 'hgnc_symbol']), default='ensembl')
+@click.option('--project-name', default='', type=str,
+              help='Name of the project. It creates a subfolder in output folder')
+@click.option('--output-path', default='', type=str,
+              help='Directory where the results will be allocated (the directory must exist) [out]')
+@click.option('--output-format', type=click.Choice(['txt', 'csv', 'tsv', 'tab']))
+@click.option('--summary-result-name', default='summary', type=str, help='Summary result namefile [summary]')
+@click.option('--chunksize', default=1000, type=int, help='Number of genes read at once from the counts file [1000]')
+@click.option('--verbose/--quiet', default=True, help='Print or hide cellphonedb logs [verbose]')
+@click.option('--database', default='latest', callback=choose_database)
+def summarize(meta_filename: str,
+              counts_filename: str,
+              counts_data: str,
+              project_name: str,
+              output_path: str,
+              output_format: Optional[str],
+              summary_result_name: str,
+              chunksize: int,
+              verbose: bool,
+              database: Optional[str],
+              ) -> None:
+    try:
+        LocalMethodLauncher(cpdb_app.create_app(verbose, database)). \
+            summarize_local_method_launcher(meta_filename,
+                                            counts_filename,
+                                            counts_data,
+                                            project_name,
+                                            output_path,
+                                            output_format,
+                                            summary_result_name,
+                                            chunksize,
+                                            )
+    except (ReadFileException, ParseMetaException, ParseCountsException) as e:
+        app_logger.error(str(e) +
+                         (':' if (hasattr(e, 'description') and e.description) or (
+                                 hasattr(e, 'hint') and e.hint) else '') +
+                         (' {}.'.format(e.description) if hasattr(e, 'description') and e.description else '') +
+                         (' {}.'.format(e.hint) if hasattr(e, 'hint') and e.hint else '')
+                         )
+    except:
+        app_logger.error('Unexpected error')
+
+        if verbose:
+            traceback.print_exc(file=sys.stdout)
+
+
+@click.command()
+@click.argument('summary-filename')
+@analysis_options
+def summary_analysis(summary_filename: str,
+                     counts_data: str,
+                     project_name: str,
+                     threshold: float,
+                     result_precision: int,
+                     output_path: str,
+                     output_format: str,
+                     output_compression: Optional[str],
+                     means_result_name: str,
+                     significant_means_result_name: str,
+                     deconvoluted_result_name: str,
+                     verbose: bool,
+                     database: Optional[str],
+                     cell_types: Optional[str],
+                     cluster_pairs: Optional[str],
+                     interactions: Optional[str],
+                     interaction_class: tuple,
+                     profile: bool,
+                     ) -> None:
+    try:
+        LocalMethodLauncher(cpdb_app.create_app(verbose, database)). \
+            cpdb_analysis_summary_local_method_launcher(summary_filename,
+                                                        counts_data,
+                                                        project_name,
+                                                        threshold,
+                                                        output_path,
+                                                        output_format,
+                                                        means_result_name,
+                                                        significant_means_result_name,
+                                                        deconvoluted_result_name,
+                                                        result_precision,
+                                                        output_compression,
+                                                        cell_types,
+                                                        cluster_pairs,
+                                                        interactions,
+                                                        interaction_class,
+                                                        profile,
+                                                        )
+    except (ReadFileException, ParseCountsException, ThresholdValueException, AllCountsFilteredException,
+            ClusterPairsException) as e:
         app_logger.error(str(e) +
                          (':' if (hasattr(e, 'description') and e.description) or (
                                  hasattr(e, 'hint') and e.hint) else '') +
@@ -5,6 +5,7 @@ from sqlalchemy import create_engine
 from cellphonedb.src.core.Cellphonedb import Cellphonedb
 from cellphonedb.src.core.core_logger import core_logger
 from cellphonedb.src.core.database.Database import Database
+from cellphonedb.src.core.database.DatabaseCache import DatabaseCache
 from cellphonedb.src.core.database.DatabaseManager import DatabaseManager
 from cellphonedb.src.core.database.sqlalchemy_models import Base
 from cellphonedb.src.core.database.sqlalchemy_repository.ComplexRepository import ComplexRepository
@@ -19,11 +20,16 @@ class CellphonedbSqlalchemy(Cellphonedb):
         core_logger.setLevel(config['logger']['level'])
         core_logger.info('Initializing SqlAlchemy CellPhoneDB Core')
 
+        cache = None
+
         if database_file:
             if not collecting and not os.path.exists(database_file):
                 raise Exception('Given database file {} does not exist'.format(database_file))
 
             uri = self._build_sqlite_uri(database_file)
+
+            if not collecting:
+                cache = DatabaseCache(database_file)
         else:
             # todo: Improve config stuff
             uri = self._build_uri(config)
@@ -33,7 +39,7 @@ class CellphonedbSqlalchemy(Cellphonedb):
         engine = create_engine(uri)
         database = Database(engine)
         database.base_model = Base
-        database_manager = DatabaseManager(None, database)
+        database_manager = DatabaseManager(None, database, cache)
         # TODO: Auto-load repositories
         database_manager.add_repository(ComplexRepository)
         database_manager.add_repository(GeneRepository)
@@ -0,0 +1,78 @@
+import glob
+import hashlib
+import os
+import pickle
+from typing import Callable
+
+import pandas as pd
+
+from cellphonedb.src.core.core_logger import core_logger
+
+
+class DatabaseCache:
+    """
+    Binary cache of the expanded tables built from a read-only database file.
+
+    The tables are pickled next to the database file, in a file named after the database size and modification time,
+    so a changed database never uses an old cache and the database doesn't need to be read to find it. Tables missing
+    in the cache are built from the database and added to it.
+    """
+
+    def __init__(self, database_file: str):
+        self.database_file = os.path.realpath(os.path.expanduser(database_file))
+        self._cache_file = None
+        self._tables = None
+
+    @property
+    def cache_file(self) -> str:
+        if self._cache_file is None:
+            database_stat = os.stat(self.database_file)
+            database_hash = hashlib.sha256('{}|{}'.format(database_stat.st_size, database_stat.st_mtime_ns).encode())
+
+            self._cache_file = '{}_cache_{}.pickle'.format(os.path.splitext(self.database_file)[0],
+                                                           database_hash.hexdigest()[:16])
+
+        return self._cache_file
+
+    def get_table(self, key: tuple, builder: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        tables = self._load()
+
+        if key not in tables:
+            core_logger.debug('Building database cache table {}'.format(key))
+            tables[key] = builder()
+            self._save()
+
+        return tables[key].copy()
+
+    def _load(self) -> dict:
+        if self._tables is None:
+            self._tables = {}
+
+            if os.path.exists(self.cache_file):
+                try:
+                    with open(self.cache_file, 'rb') as f:
+                        self._tables = pickle.load(f)
+                except Exception as e:
+                    core_logger.warning('Ignoring unreadable database cache {}: {}'.format(self.cache_file, e))
+
+        return self._tables
+
+    def _save(self) -> None:
+        temporal_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+
+        try:
+            with open(temporal_file, 'wb') as f:
+                pickle.dump(self._tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporal_file, self.cache_file)
+        except OSError as e:
+            core_logger.debug('Database cache {} not saved: {}'.format(self.cache_file, e))
+            return
+
+        cache_pattern = '{}_cache_*.pickle'.format(os.path.splitext(self.database_file)[0])
+        for old_cache_file in glob.glob(cache_pattern):
+            if old_cache_file != self.cache_file:
+                try:
+                    os.remove(old_cache_file)
+                except OSError:
+                    # Already removed by another process saving its cache
+                    pass
@@ -1,7 +1,15 @@
+from typing import Optional, Callable
+
+import pandas as pd
+
+from cellphonedb.src.core.database.DatabaseCache import DatabaseCache
+
+
 class DatabaseManager:
-    def __init__(self, repositories, db=None):
+    def __init__(self, repositories, db=None, cache: Optional[DatabaseCache] = None):
         self._repositories = repositories
         self.database = db
+        self.cache = cache
 
     # TODO: Throw error
     def add_repository(self, repository):
@@ -13,6 +21,15 @@ class DatabaseManager:
     def get_repository(self, respository_name):
         return self._repositories[respository_name](self)
 
+    def get_cached_table(self, key: tuple, builder: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Returns the table from the database cache, if available, building it on cache miss
+        """
+        if self.cache is None:
+            return builder()
+
+        return self.cache.get_table(key, builder)
+
     def get_column_table_names(self, model_name: str) -> object:
         def get_model():
             for c in self.database.base_model._decl_class_registry.values():
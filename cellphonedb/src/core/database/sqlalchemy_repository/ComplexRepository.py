@@ -20,12 +20,18 @@ class ComplexRepository(Repository):
         return result
 
     def get_all_expanded(self) -> pd.DataFrame:
+        return self.database_manager.get_cached_table(('complex_expanded',), self._get_all_expanded)
+
+    def _get_all_expanded(self) -> pd.DataFrame:
         query = self.database_manager.database.session.query(Complex, Multidata).join(Multidata)
         result = pd.read_sql(query.statement, self.database_manager.database.engine)
 
         return result
 
     def get_all_compositions(self) -> pd.DataFrame:
+        return self.database_manager.get_cached_table(('complex_composition',), self._get_all_compositions)
+
+    def _get_all_compositions(self) -> pd.DataFrame:
         query = self.database_manager.database.session.query(ComplexComposition)
         result = pd.read_sql(query.statement, self.database_manager.database.engine)
 
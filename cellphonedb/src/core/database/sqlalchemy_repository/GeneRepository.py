@@ -18,6 +18,9 @@ class GeneRepository(Repository):
         return result
 
     def get_all_expanded(self):
+        return self.database_manager.get_cached_table(('gene_expanded',), self._get_all_expanded)
+
+    def _get_all_expanded(self):
         protein_multidata_join = Protein.protein_multidata_id == Multidata.id_multidata
         gene_protein_join = Gene.protein_id == Protein.id_protein
         query = self.database_manager.database.session.query(Gene, Protein, Multidata).join(
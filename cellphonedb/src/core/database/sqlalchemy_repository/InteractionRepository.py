@@ -1,21 +1,86 @@
+from typing import Optional
+
 import pandas as pd
 from sqlalchemy import or_
 
 from cellphonedb.src.core.database.Repository import Repository
+from cellphonedb.src.core.database.sqlalchemy_models.db_model_complex_composition import ComplexComposition
+from cellphonedb.src.core.database.sqlalchemy_models.db_model_gene import Gene
 from cellphonedb.src.core.database.sqlalchemy_models.db_model_interaction import Interaction
+from cellphonedb.src.core.database.sqlalchemy_models.db_model_multidata import Multidata
+from cellphonedb.src.core.database.sqlalchemy_models.db_model_protein import Protein
 from cellphonedb.src.core.models.interaction.interaction_helper import expand_interactions_multidatas
 from cellphonedb.src.core.utils import filters
 
 
 class InteractionRepository(Repository):
     name = 'interaction'
+    interaction_classes = ['secreted', 'integrin', 'receptor']
+
+    # The names are used 15 times in the filter query, this keeps it under the SQLite limit of 999 parameters
+    filter_names_chunk_size = 50
+
+    def get_all(self, interactions_filter: Optional[dict] = None):
+        if interactions_filter:
+            return self._get_filtered(interactions_filter)
 
-    def get_all(self):
+        return self.database_manager.get_cached_table(('interaction',), self._get_all)
+
+    def _get_all(self):
         query = self.database_manager.database.session.query(Interaction)
         interactions = pd.read_sql(query.statement, self.database_manager.database.engine)
 
         return interactions
 
+    def _get_filtered(self, interactions_filter: dict) -> pd.DataFrame:
+        """
+        Returns the interactions selected in the database query by interactions_filter:
+            - names: interaction ids, partner names or genes (ensembl, gene name or hgnc symbol) of a partner or of a
+              complex partner component
+            - classes: interactions with a secreted, integrin or receptor partner (any of the classes)
+        """
+        names = interactions_filter.get('names')
+        classes = interactions_filter.get('classes')
+
+        names_chunks = [names[start:start + self.filter_names_chunk_size]
+                        for start in range(0, len(names), self.filter_names_chunk_size)] if names else [None]
+
+        interactions = []
+        for names_chunk in names_chunks:
+            query = self.database_manager.database.session.query(Interaction)
+            if names_chunk is not None:
+                query = query.filter(self._names_condition(names_chunk))
+            if classes:
+                query = query.filter(self._classes_condition(classes))
+
+            interactions.append(pd.read_sql(query.statement, self.database_manager.database.engine))
+
+        interactions = pd.concat(interactions, ignore_index=True)
+        interactions.drop_duplicates('id_interaction', inplace=True)
+        interactions.reset_index(drop=True, inplace=True)
+
+        return interactions
+
+    def _names_condition(self, names: list):
+        session = self.database_manager.database.session
+
+        proteins_ids = session.query(Protein.protein_multidata_id).join(Gene, Gene.protein_id == Protein.id_protein) \
+            .filter(or_(Gene.ensembl.in_(names), Gene.gene_name.in_(names), Gene.hgnc_symbol.in_(names)))
+        complexes_ids = session.query(ComplexComposition.complex_multidata_id) \
+            .filter(ComplexComposition.protein_multidata_id.in_(proteins_ids))
+        partners_ids = session.query(Multidata.id_multidata).filter(Multidata.name.in_(names)) \
+            .union(proteins_ids, complexes_ids)
+
+        return or_(Interaction.id_cp_interaction.in_(names),
+                   Interaction.multidata_1_id.in_(partners_ids),
+                   Interaction.multidata_2_id.in_(partners_ids))
+
+    def _classes_condition(self, classes: list):
+        partners_ids = self.database_manager.database.session.query(Multidata.id_multidata) \
+            .filter(or_(*[getattr(Multidata, interaction_class) for interaction_class in classes]))
+
+        return or_(Interaction.multidata_1_id.in_(partners_ids), Interaction.multidata_2_id.in_(partners_ids))
+
     def get_interactions_by_multidata_id(self, id):
         """
 
@@ -40,10 +105,23 @@ class InteractionRepository(Repository):
         interactions_expanded = expand_interactions_multidatas(interactions, multidatas_expanded)
         return interactions_expanded
 
-    def get_all_expanded(self, include_gene=True, suffixes=('_1', '_2')):
-        interactions_query = self.database_manager.database.session.query(Interaction)
-
-        interactions = pd.read_sql(interactions_query.statement, self.database_manager.database.engine)
+    def get_all_expanded(self, include_gene=True, suffixes=('_1', '_2'), interactions_filter: Optional[dict] = None):
+        """
+        Returns the interactions with the partners data. If interactions_filter is set, only the interactions selected
+        by it are queried (see _get_filtered)
+        """
+        if interactions_filter:
+            return self._get_all_expanded(include_gene, suffixes, interactions_filter)
+
+        return self.database_manager.get_cached_table(('interaction_expanded', include_gene, tuple(suffixes)),
+                                                      lambda: self._get_all_expanded(include_gene, suffixes))
+
+    def _get_all_expanded(self, include_gene, suffixes, interactions_filter: Optional[dict] = None):
+        if interactions_filter:
+            interactions = self._get_filtered(interactions_filter)
+        else:
+            interactions_query = self.database_manager.database.session.query(Interaction)
+            interactions = pd.read_sql(interactions_query.statement, self.database_manager.database.engine)
 
         multidata_expanded = self.database_manager.get_repository('multidata').get_all_expanded(include_gene)
 
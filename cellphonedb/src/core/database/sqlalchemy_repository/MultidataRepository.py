@@ -17,6 +17,10 @@ class MultidataRepository(Repository):
         return result
 
     def get_all_expanded(self, include_gene=True):
+        return self.database_manager.get_cached_table(('multidata_expanded', include_gene),
+                                                      lambda: self._get_all_expanded(include_gene))
+
+    def _get_all_expanded(self, include_gene):
         protein_multidata_join = Protein.protein_multidata_id == Multidata.id_multidata
         if include_gene:
             gene_protein_join = Gene.protein_id == Protein.id_protein
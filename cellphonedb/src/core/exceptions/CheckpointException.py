@@ -0,0 +1,5 @@
+class CheckpointException(Exception):
+    def __init__(self, description: str = None, hint: str = None):
+        super(CheckpointException, self).__init__('Invalid statistical analysis checkpoint')
+        self.description = description
+        self.hint = hint
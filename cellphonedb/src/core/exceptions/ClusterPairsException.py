@@ -0,0 +1,5 @@
+class ClusterPairsException(Exception):
+    def __init__(self, description: str = None, hint: str = None):
+        super(ClusterPairsException, self).__init__('Invalid cell types selection')
+        self.description = description
+        self.hint = hint
@@ -0,0 +1,4 @@
+class PvalueMethodException(Exception):
+    def __init__(self, pvalue_method):
+        super(PvalueMethodException, self).__init__(
+            'Pvalue method ({}) is not valid. Accepted values: permutation, approximate'.format(pvalue_method))
@@ -1,10 +1,14 @@
+from typing import Optional
+
 import pandas as pd
 
 from cellphonedb.src.core.exceptions.EmptyResultException import EmptyResultException
 from cellphonedb.src.core.methods import cpdb_analysis_simple_method, cpdb_analysis_complex_method
+from cellphonedb.src.core.utils.counts_summary import CountsSummary
+from cellphonedb.src.core.utils.profiler import Profiler
 
 
-def call(meta: pd.DataFrame,
+def call(meta: Optional[pd.DataFrame],
          counts: pd.DataFrame,
          counts_data: str,
          interactions: pd.DataFrame,
@@ -13,26 +17,43 @@ def call(meta: pd.DataFrame,
          complex_compositions: pd.DataFrame,
          separator: str,
          threshold: float = 0.1,
-         result_precision: int = 3) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
-    means_simple, significant_means_simple, deconvoluted_simple = \
-        cpdb_analysis_simple_method.call(meta.copy(),
-                                         counts.copy(),
-                                         counts_data,
-                                         interactions.copy(),
-                                         separator,
-                                         threshold,
-                                         result_precision)
-    means_complex, significant_means_complex, deconvoluted_complex = \
-        cpdb_analysis_complex_method.call(meta.copy(),
-                                          counts.copy(),
-                                          counts_data,
-                                          interactions.copy(),
-                                          genes,
-                                          complexes,
-                                          complex_compositions,
-                                          separator,
-                                          threshold,
-                                          result_precision)
+         result_precision: int = 3,
+         cluster_pairs: Optional[list] = None,
+         profiler: Optional[Profiler] = None,
+         summary: Optional[CountsSummary] = None) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
+    """
+    If summary is set, the clusters means and percents are taken from it instead of the meta cells counts: counts
+    are then the genes x cell types sums of the summary and meta is not used.
+    """
+    profiler = profiler or Profiler()
+
+    with profiler.stage('simple_analysis'):
+        means_simple, significant_means_simple, deconvoluted_simple = \
+            cpdb_analysis_simple_method.call(_copy(meta),
+                                             counts.copy(),
+                                             counts_data,
+                                             interactions.copy(),
+                                             separator,
+                                             threshold,
+                                             result_precision,
+                                             cluster_pairs,
+                                             profiler,
+                                             summary)
+    with profiler.stage('complex_analysis'):
+        means_complex, significant_means_complex, deconvoluted_complex = \
+            cpdb_analysis_complex_method.call(_copy(meta),
+                                              counts.copy(),
+                                              counts_data,
+                                              interactions.copy(),
+                                              genes,
+                                              complexes,
+                                              complex_compositions,
+                                              separator,
+                                              threshold,
+                                              result_precision,
+                                              cluster_pairs,
+                                              profiler,
+                                              summary)
 
     means = means_simple.append(means_complex, sort=False)
     significant_means = significant_means_simple.append(significant_means_complex, sort=False)
@@ -48,3 +69,7 @@ def call(meta: pd.DataFrame,
     significant_means.sort_values('rank', inplace=True)
 
     return means, significant_means, deconvoluted
+
+
+def _copy(meta: Optional[pd.DataFrame]) -> Optional[pd.DataFrame]:
+    return meta.copy() if meta is not None else None
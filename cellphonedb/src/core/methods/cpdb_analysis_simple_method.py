@@ -1,7 +1,11 @@
+from typing import Optional
+
 import pandas as pd
 
 from cellphonedb.src.core.core_logger import core_logger
 from cellphonedb.src.core.methods import cpdb_statistical_analysis_helper, cpdb_analysis_helper
+from cellphonedb.src.core.utils.counts_summary import CountsSummary
+from cellphonedb.src.core.utils.profiler import Profiler
 
 
 def call(meta: pd.DataFrame,
@@ -10,47 +14,62 @@ def call(meta: pd.DataFrame,
          interactions: pd.DataFrame,
          separator: str,
          threshold: float = 0.1,
-         result_precision: int = 3
+         result_precision: int = 3,
+         cluster_pairs: Optional[list] = None,
+         profiler: Optional[Profiler] = None,
+         summary: Optional[CountsSummary] = None
          ) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
     core_logger.info(
         '[Non Statistical Method] Threshold:{} Precission:{}'.format(threshold, result_precision))
+    profiler = profiler or Profiler()
 
-    interactions_filtered, counts_filtered = prefilters(counts, interactions, counts_data)
+    with profiler.stage('prefilters'):
+        interactions_filtered, counts_filtered = prefilters(counts, interactions, counts_data)
 
     if interactions_filtered.empty or counts_filtered.empty:
         return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
 
-    clusters = cpdb_statistical_analysis_helper.build_clusters(meta, counts_filtered)
+    with profiler.stage('build_clusters'):
+        if summary is None:
+            clusters = cpdb_statistical_analysis_helper.build_clusters(meta, counts_filtered)
+        else:
+            clusters = summary.build_clusters(counts_filtered.index)
     core_logger.info('Running Simple Analysis')
-    cluster_interactions = cpdb_statistical_analysis_helper.get_cluster_combinations(clusters['names'])
-
-    base_result = cpdb_statistical_analysis_helper.build_result_matrix(interactions_filtered, cluster_interactions,
-                                                                       separator)
-
-    mean_analysis = cpdb_statistical_analysis_helper.mean_analysis(interactions_filtered,
-                                                                   clusters,
-                                                                   cluster_interactions,
-                                                                   base_result,
-                                                                   separator,
-                                                                   suffixes=('_1', '_2'),
-                                                                   counts_data=counts_data)
-
-    percent_analysis = cpdb_analysis_helper.percent_analysis(clusters,
-                                                             threshold,
-                                                             interactions_filtered,
-                                                             cluster_interactions,
-                                                             base_result,
-                                                             separator,
-                                                             suffixes=('_1', '_2'),
-                                                             counts_data=counts_data)
-
-    means_result, significant_means, deconvoluted_result = build_results(
-        interactions_filtered,
-        mean_analysis,
-        percent_analysis,
-        clusters['means'],
-        result_precision,
-        counts_data)
+    cluster_interactions = cpdb_statistical_analysis_helper.get_cluster_combinations(clusters['names'],
+                                                                                     cluster_pairs)
+
+    profiler.set_dimensions(simple_genes=len(counts_filtered), simple_interactions=len(interactions_filtered),
+                            cluster_pairs=len(cluster_interactions))
+
+    with profiler.stage('real_analysis'):
+        base_result = cpdb_statistical_analysis_helper.build_result_matrix(interactions_filtered, cluster_interactions,
+                                                                           separator)
+
+        mean_analysis = cpdb_statistical_analysis_helper.mean_analysis(interactions_filtered,
+                                                                       clusters,
+                                                                       cluster_interactions,
+                                                                       base_result,
+                                                                       separator,
+                                                                       suffixes=('_1', '_2'),
+                                                                       counts_data=counts_data)
+
+        percent_analysis = cpdb_analysis_helper.percent_analysis(clusters,
+                                                                 threshold,
+                                                                 interactions_filtered,
+                                                                 cluster_interactions,
+                                                                 base_result,
+                                                                 separator,
+                                                                 suffixes=('_1', '_2'),
+                                                                 counts_data=counts_data)
+
+    with profiler.stage('build_results'):
+        means_result, significant_means, deconvoluted_result = build_results(
+            interactions_filtered,
+            mean_analysis,
+            percent_analysis,
+            clusters['means'],
+            result_precision,
+            counts_data)
 
     return means_result, significant_means, deconvoluted_result
 
@@ -1,5 +1,4 @@
-from functools import partial
-
+import numpy as np
 import pandas as pd
 
 from cellphonedb.src.core.core_logger import core_logger
@@ -9,101 +8,6 @@ from cellphonedb.src.core.models.cluster_counts import cluster_counts_helper, cl
 from cellphonedb.src.core.models.complex import complex_helper
 
 
-def call(meta: pd.DataFrame,
-         counts: pd.DataFrame,
-         counts_data: str,
-         interactions: pd.DataFrame,
-         genes: pd.DataFrame,
-         complexes: pd.DataFrame,
-         complex_compositions: pd.DataFrame,
-         pvalue: float,
-         separator: str,
-         iterations: int = 1000,
-         threshold: float = 0.1,
-         threads: int = 4,
-         debug_seed: int = -1,
-         result_precision: int = 3,
-         ) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame):
-    core_logger.info(
-        '[Cluster Statistical Analysis Complex] '
-        'Threshold:{} Iterations:{} Debug-seed:{} Threads:{} Precision:{}'.format(threshold,
-                                                                                  iterations,
-                                                                                  debug_seed,
-                                                                                  threads,
-                                                                                  result_precision))
-    if debug_seed >= 0:
-        pd.np.random.seed(debug_seed)
-        core_logger.warning('Debug random seed enabled. Setted to {}'.format(debug_seed))
-
-    cells_names = sorted(counts.columns)
-
-    interactions_filtered, counts_filtered, complex_in_counts = prefilters(interactions, counts, genes, complexes,
-                                                                           complex_compositions, counts_data)
-    if interactions_filtered.empty:
-        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-
-    complex_significative_protein = get_complex_significative(complex_in_counts, counts_filtered, complex_compositions,
-                                                              cells_names)
-
-    clusters = cpdb_statistical_analysis_helper.build_clusters(meta, counts_filtered)
-    core_logger.info('Running Real Complex Analysis')
-
-    cluster_interactions = cpdb_statistical_analysis_helper.get_cluster_combinations(clusters['names'])
-    interactions_processed = get_interactions_processed(interactions_filtered, complex_significative_protein,
-                                                        counts_data=counts_data)
-
-    base_result = cpdb_statistical_analysis_helper.build_result_matrix(interactions_processed,
-                                                                       cluster_interactions,
-                                                                       separator)
-
-    real_mean_analysis = cpdb_statistical_analysis_helper.mean_analysis(interactions_processed,
-                                                                        clusters,
-                                                                        cluster_interactions,
-                                                                        base_result,
-                                                                        separator,
-                                                                        counts_data=counts_data)
-
-    real_percents_analysis = cpdb_statistical_analysis_helper.percent_analysis(clusters,
-                                                                               threshold,
-                                                                               interactions_processed,
-                                                                               cluster_interactions,
-                                                                               base_result,
-                                                                               separator,
-                                                                               counts_data=counts_data)
-
-    statistical_mean_analysis = cpdb_statistical_analysis_helper.shuffled_analysis(iterations,
-                                                                                   meta,
-                                                                                   counts_filtered,
-                                                                                   interactions_processed,
-                                                                                   cluster_interactions,
-                                                                                   base_result,
-                                                                                   threads,
-                                                                                   separator,
-                                                                                   counts_data=counts_data)
-
-    result_percent = cpdb_statistical_analysis_helper.build_percent_result(real_mean_analysis,
-                                                                           real_percents_analysis,
-                                                                           statistical_mean_analysis,
-                                                                           interactions_processed,
-                                                                           cluster_interactions,
-                                                                           base_result,
-                                                                           separator)
-
-    pvalues_result, means_result, significant_means, deconvoluted_result = build_results(
-        interactions_filtered,
-        real_mean_analysis,
-        result_percent,
-        clusters['means'],
-        complex_compositions,
-        counts,
-        genes,
-        result_precision,
-        pvalue,
-        counts_data
-    )
-    return pvalues_result, means_result, significant_means, deconvoluted_result
-
-
 def build_results(interactions: pd.DataFrame,
                   real_mean_analysis: pd.DataFrame,
                   result_percent: pd.DataFrame,
@@ -272,7 +176,7 @@ def get_interactions_processed(interactions: pd.DataFrame, complex_significative
                                counts_data: str = 'ensembl') -> pd.DataFrame:
     """
     Returns a interaction dataframe [ensembl_1/ensembl_2] with complex data changed to complex_significative_gene.
-    Interactions index don't changes
+    Interactions index don't changes. The complexes genes are taken by position in complex_significative_gene.
 
     EXAMPLE:
         INPUT:
@@ -296,46 +200,39 @@ def get_interactions_processed(interactions: pd.DataFrame, complex_significative
         1   ensembla    ensemblw
         2   ensemblx    ensemblb
         3   ensembly    ensemblz
-    """
 
-    def interaction_processed_builder(interaction: pd.Series, prefix: str) -> pd.Series:
+    Raises KeyError if some interaction complex is not in complex_significative_gene.
+    """
 
-        built = pd.Series()
+    processed_interactions = pd.DataFrame(index=interactions.index)
 
-        if interaction['is_complex_1']:
-            built['{}_1'.format(prefix)] = complex_significative_gene[interaction['name_1']]
-        else:
-            built['{}_1'.format(prefix)] = interaction['{}_1'.format(prefix)]
+    for suffix in ('_1', '_2'):
+        names = interactions['name{}'.format(suffix)]
+        complex_positions = complex_significative_gene.index.get_indexer(names)
+        is_complex = interactions['is_complex{}'.format(suffix)].astype(bool).values
 
-        if interaction['is_complex_2']:
-            built['{}_2'.format(prefix)] = complex_significative_gene[interaction['name_2']]
-        else:
-            built['{}_2'.format(prefix)] = interaction['{}_2'.format(prefix)]
-        return built
+        missing_complexes = is_complex & (complex_positions == -1)
+        if missing_complexes.any():
+            raise KeyError('Interactions complexes without significative gene: {}'.format(
+                ', '.join(sorted(set(map(str, names[missing_complexes]))))))
 
-    processed_interactions = interactions.apply(partial(interaction_processed_builder, prefix=counts_data), axis=1)
+        processed_interactions['{}{}'.format(counts_data, suffix)] = np.where(
+            is_complex, complex_significative_gene.values[complex_positions],
+            interactions['{}{}'.format(counts_data, suffix)].values)
 
     return processed_interactions
 
 
-# TODO: Needs refactor too slow
 def filter_interactions_by_genes(interactions: pd.DataFrame, genes: list, counts_data: str = 'ensembl') -> pd.DataFrame:
     """
     Removes interactions if the ensembl is not in genes list. If is it a complex, don't check
     """
+    simple_in_genes_1 = ~interactions['is_complex_1'].astype(bool) & interactions[
+        '{}_1'.format(counts_data)].isin(genes)
+    simple_in_genes_2 = ~interactions['is_complex_2'].astype(bool) & interactions[
+        '{}_2'.format(counts_data)].isin(genes)
 
-    def filter_by_non_complex_element(interaction: pd.Series) -> bool:
-        if not interaction['is_complex_1']:
-            if interaction['{}_1'.format(counts_data)] in genes:
-                return True
-
-        if not interaction['is_complex_2']:
-            if interaction['{}_2'.format(counts_data)] in genes:
-                return True
-
-        return False
-
-    interactions_filtered = interactions[interactions.apply(filter_by_non_complex_element, axis=1)]
+    interactions_filtered = interactions[simple_in_genes_1 | simple_in_genes_2]
     return interactions_filtered
 
 
@@ -351,7 +248,7 @@ def prefilters(interactions: pd.DataFrame, counts: pd.DataFrame, genes: pd.DataF
     """
     core_logger.info('Running Complex Prefilters')
     clusters_names = sorted(counts.columns.values)
-    counts['gene'] = counts.index
+    counts = counts.assign(gene=counts.index)
 
     counts_multidata = cluster_counts_filter.filter_by_gene(counts, genes, counts_data=counts_data)
 
@@ -384,12 +281,10 @@ def filter_interactions_by_complexes(interactions: pd.DataFrame, complexes: pd.D
     """
     Remove interactiontion if one of these components is not in complexes dataframe
     """
-    complex_ids = complexes['complex_multidata_id'].tolist()
+    complex_ids = complexes['complex_multidata_id']
 
-    interactions_filtered = interactions[interactions.apply(
-        lambda interaction: (interaction['multidata_1_id'] in complex_ids) or
-                            (interaction['multidata_2_id'] in complex_ids),
-        axis=1)].copy()
+    interactions_filtered = interactions[interactions['multidata_1_id'].isin(complex_ids) |
+                                         interactions['multidata_2_id'].isin(complex_ids)].copy()
 
     interactions_filtered.drop_duplicates('id_cp_interaction', inplace=True)
 
@@ -400,7 +295,7 @@ def filter_counts_by_genes(counts: pd.DataFrame, genes: list) -> pd.DataFrame:
     """
     remove count if is not defined in genes list
     """
-    counts_filtered = counts[counts['gene'].apply(lambda gene: gene in genes)]
+    counts_filtered = counts[counts['gene'].isin(genes)]
 
     return counts_filtered
 
@@ -411,11 +306,10 @@ def get_involved_complex_from_counts(multidatas_counts: pd.DataFrame, clusters_n
     """
     Finds the complexes defined in counts and calculates the counts values
     """
-    proteins_in_complexes = complex_composition['protein_multidata_id'].tolist()
+    proteins_in_complexes = complex_composition['protein_multidata_id']
 
     # Remove counts that can't be part of a complex
-    multidatas_counts_filtered = multidatas_counts[
-        multidatas_counts['id_multidata'].apply(lambda multidata: multidata in proteins_in_complexes)]
+    multidatas_counts_filtered = multidatas_counts[multidatas_counts['id_multidata'].isin(proteins_in_complexes)]
 
     # Find complexes with all components defined in counts
     complex_composition_counts = complex_helper.get_involved_complex_from_protein(multidatas_counts_filtered,
@@ -447,29 +341,22 @@ def get_complex_significative(complexes: pd.DataFrame, counts: pd.DataFrame, com
     """
     Returns a table with the most significant ensembl count for one complex.
 
-    The most significative count is the lower mean of the components.
-
-
-
+    The most significative count is the lower mean of the components. The means over the cells are calculated once
+    for each gene and the complexes take the component with the minimum one.
     """
-    complex_composition_complexes = pd.merge(complexes, complex_composition, on='complex_multidata_id')
-
-    complex_counts = pd.merge(counts, complex_composition_complexes, left_on='id_multidata',
-                              right_on='protein_multidata_id', suffixes=('_protein', '_complex'))
-
-    complex_more_significative_protein = pd.Series(data='', index=complex_counts['name_complex'].drop_duplicates())
-
-    for _, complex in complexes.iterrows():
-        complex_composition_proteins = complex_counts[complex_counts['id_complex'] == complex['id_complex']]
+    genes_means = counts[['id_multidata', 'gene']].assign(mean=counts[cells_names].mean(axis=1))
 
-        means = pd.Series(index=complex_composition_proteins['gene'])
+    complex_composition_complexes = pd.merge(complexes[['complex_multidata_id', 'name']],
+                                             complex_composition[['complex_multidata_id', 'protein_multidata_id']],
+                                             on='complex_multidata_id')
 
-        for _, complex_composition_protein in complex_composition_proteins.iterrows():
-            means[complex_composition_protein['gene']] = complex_composition_protein[cells_names].mean()
+    complex_genes_means = pd.merge(genes_means, complex_composition_complexes, left_on='id_multidata',
+                                   right_on='protein_multidata_id').reset_index(drop=True)
 
-        min_mean = means.idxmin()
+    min_mean_rows = complex_genes_means.groupby('complex_multidata_id', sort=False)['mean'].idxmin()
 
-        complex_more_significative_protein.at[complex['name']] = min_mean
+    complex_more_significative_protein = pd.Series(complex_genes_means.loc[min_mean_rows, 'gene'].values,
+                                                   index=complex_genes_means.loc[min_mean_rows, 'name'].values)
 
     return complex_more_significative_protein
 
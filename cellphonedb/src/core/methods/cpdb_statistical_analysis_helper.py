@@ -1,10 +1,17 @@
+import hashlib
 import itertools
-from functools import partial
+import os
+import tempfile
 from multiprocessing.pool import Pool
+from typing import Union, Optional
 
+import numpy as np
 import pandas as pd
+from scipy import sparse, stats
 
 from cellphonedb.src.core.core_logger import core_logger
+from cellphonedb.src.core.exceptions.CheckpointException import CheckpointException
+from cellphonedb.src.core.exceptions.ClusterPairsException import ClusterPairsException
 
 
 def get_significant_means(real_mean_analysis: pd.DataFrame, result_percent: pd.DataFrame,
@@ -37,42 +44,120 @@ def get_significant_means(real_mean_analysis: pd.DataFrame, result_percent: pd.D
     ensembl2    2.0         0.1         NaN
     ensembl3    NaN         NaN         0.5
     """
-    significant_means = real_mean_analysis.copy()
-    for index, mean_analysis in real_mean_analysis.iterrows():
-        for cluster_interaction in list(result_percent.columns):
-            if result_percent.at[index, cluster_interaction] > min_significant_mean:
-                significant_means.at[index, cluster_interaction] = pd.np.nan
+    significant_means = real_mean_analysis.mask(result_percent.values > min_significant_mean)
+
     return significant_means
 
 
-def shuffle_meta(meta: pd.DataFrame) -> pd.DataFrame:
+def shuffle_cells_clusters(cells_clusters: np.ndarray, seed: int, iteration: int) -> np.ndarray:
+    """
+    Permutates the cells clusters aleatory generating a new cells to clusters assignment.
+
+    Each iteration draws from its own generator, spawned from the seed and the iteration number, so the permutation
+    doesn't depend on the worker that runs it.
+
+    The permutations, and so the pvalues, are bit-identical for a given seed only within one numpy version: the
+    Generator streams changed between numpy releases (1.17 and 1.18 differ), so the results are compared against
+    baselines generated with the pinned numpy.
+    """
+    random_generator = np.random.default_rng(np.random.SeedSequence(entropy=seed, spawn_key=(iteration,)))
+
+    return random_generator.permutation(cells_clusters)
+
+
+def get_cells_clusters(meta: pd.DataFrame, cluster_names: list) -> np.ndarray:
+    """
+    Returns the position in cluster_names of the cluster of each meta cell
+    """
+    return pd.Categorical(meta['cell_type'], categories=cluster_names).codes.astype(int)
+
+
+def build_clusters_means(counts_matrix: np.ndarray, cells_clusters: np.ndarray, clusters_number: int) -> np.ndarray:
+    """
+    Calculates the genes x clusters means for one or a batch of cells to clusters assignments.
+
+    The cluster sums are computed for the whole batch with a single product of the genes x cells counts matrix and a
+    sparse cells x (batch * clusters) indicator matrix.
+
+    EXAMPLE:
+        INPUT:
+        counts_matrix
+                cell1   cell2   cell3
+        gene1   0.1     0.3     0.5
+        gene2   0.0     0.2     0.4
+
+        cells_clusters = [[0, 0, 1], [1, 0, 1]]
+        clusters_number = 2
+
+        RESULT:
+        [[[0.2, 0.5],       [[0.3, 0.3],
+          [0.1, 0.4]],       [0.2, 0.2]]]
     """
-    Permutates the meta values aleatory generating a new meta file
+    cells_clusters = np.atleast_2d(cells_clusters)
+    batch_size, cells_number = cells_clusters.shape
+
+    indicator_columns = cells_clusters + np.arange(batch_size)[:, np.newaxis] * clusters_number
+    indicator = sparse.csr_matrix((np.ones(cells_number * batch_size),
+                                   indicator_columns.T.ravel(),
+                                   np.arange(0, cells_number * batch_size + 1, batch_size)),
+                                  shape=(cells_number, batch_size * clusters_number))
+
+    clusters_sums = indicator.T.dot(counts_matrix.T).reshape(batch_size, clusters_number, -1)
+    clusters_sizes = np.bincount(cells_clusters[0], minlength=clusters_number)
+
+    clusters_means = clusters_sums.transpose(0, 2, 1) / clusters_sizes
+
+    return clusters_means
+
+
+def build_clusters_percents(counts_matrix: np.ndarray, cells_clusters: np.ndarray, clusters_number: int) -> np.ndarray:
     """
-    meta_copy = meta.copy()
-    pd.np.random.shuffle(meta_copy['cell_type'])
+    Calculates the genes x clusters fraction of cells with positive counts, as the cluster means of the
+    expressed (count > 0) indicator.
 
-    return meta_copy
+    EXAMPLE:
+        INPUT:
+        counts_matrix
+                cell1   cell2   cell3
+        gene1   0.1     0.0     0.5
+        gene2   0.0     0.0     0.4
+
+        cells_clusters = [0, 0, 1]
+        clusters_number = 2
+
+        RESULT:
+        [[0.5, 1.0],
+         [0.0, 1.0]]
+    """
+    expressed = (counts_matrix > 0).astype(float)
+
+    return build_clusters_means(expressed, cells_clusters, clusters_number)[0]
 
 
 def build_clusters(meta: pd.DataFrame, counts: pd.DataFrame) -> dict:
     """
-    Builds a cluster structure and calculates the means values
+    Builds a cluster structure and calculates the means values and the fraction of expressing cells.
+
+    The means and percents are calculated once for the unique genes, in genes x clusters tables ('means_table' and
+    'percents_table', with the genes in 'genes'), and the interactions results gather them by index.
+    'means' keeps the means of each cluster as a Series.
     """
     cluster_names = meta['cell_type'].drop_duplicates().tolist()
-    clusters = {'names': cluster_names, 'counts': {}, 'means': {}}
 
-    cluster_counts = {}
-    cluster_means = {}
+    counts_matrix = counts.loc[:, meta.index].values
+    cells_clusters = get_cells_clusters(meta, cluster_names)
 
-    for cluster_name in cluster_names:
-        cells = meta[meta['cell_type'] == cluster_name].index
-        cluster_count = counts.loc[:, cells]
-        cluster_counts[cluster_name] = cluster_count
-        cluster_means[cluster_name] = cluster_count.apply(lambda count: count.mean(), axis=1)
+    clusters_means = build_clusters_means(counts_matrix, cells_clusters, len(cluster_names))[0]
+    clusters_percents = build_clusters_percents(counts_matrix, cells_clusters, len(cluster_names))
 
-    clusters['counts'] = cluster_counts
-    clusters['means'] = cluster_means
+    cluster_means = {cluster_name: pd.Series(clusters_means[:, cluster_position], index=counts.index)
+                     for cluster_position, cluster_name in enumerate(cluster_names)}
+
+    clusters = {'names': cluster_names,
+                'genes': counts.index,
+                'means_table': clusters_means,
+                'percents_table': clusters_percents,
+                'means': cluster_means}
 
     return clusters
 
@@ -116,9 +201,9 @@ def mean_pvalue_result_build(real_mean_analysis: pd.DataFrame, result_percent: p
     return mean_pvalue_result
 
 
-def get_cluster_combinations(cluster_names: list) -> list:
+def get_cluster_combinations(cluster_names: list, cluster_pairs: Optional[list] = None) -> list:
     """
-    Calculates and sort combinations including itself
+    Calculates and sort combinations including itself. If cluster_pairs is set, only these combinations are returned
 
     ie
 
@@ -131,9 +216,61 @@ def get_cluster_combinations(cluster_names: list) -> list:
      ('cluster3','cluster1'),('cluster3','cluster2'),('cluster3','cluster3')]
 
     """
+    if cluster_pairs is not None:
+        return sorted(set(cluster_pairs))
+
     return sorted(itertools.product(cluster_names, repeat=2))
 
 
+def select_cluster_pairs(cluster_names: list, cell_types: Optional[list] = None, cluster_pairs: Optional[list] = None,
+                         separator: str = '|') -> Optional[list]:
+    """
+    Builds the (sender, receiver) cluster combinations to evaluate from a list of cell types (all the combinations
+    between them) and/or a list of sender|receiver pairs. Returns None if no selection is set, to evaluate all of them.
+
+    EXAMPLE:
+        INPUT:
+        cluster_names = ['cluster1', 'cluster2', 'cluster3']
+        cell_types = ['cluster1', 'cluster2']
+        cluster_pairs = ['cluster1|cluster2', 'cluster2|cluster2', 'cluster3|cluster1']
+
+        RESULT:
+        [('cluster1', 'cluster2'), ('cluster2', 'cluster2')]
+    """
+    if cell_types is None and cluster_pairs is None:
+        return None
+
+    cluster_names_by_label = {str(cluster_name): cluster_name for cluster_name in cluster_names}
+    selected_combinations = set(itertools.product(cluster_names, repeat=2))
+
+    if cell_types is not None:
+        unknown_cell_types = [cell_type for cell_type in cell_types if cell_type not in cluster_names_by_label]
+        if unknown_cell_types:
+            raise ClusterPairsException('Cell types not found in meta: {}'.format(', '.join(unknown_cell_types)),
+                                        'Check the cell_type column of the meta file')
+
+        cell_types = [cluster_names_by_label[cell_type] for cell_type in cell_types]
+        selected_combinations &= set(itertools.product(cell_types, repeat=2))
+
+    if cluster_pairs is not None:
+        combinations = set()
+        for cluster_pair in cluster_pairs:
+            pair = cluster_pair.split(separator)
+            if len(pair) != 2 or not all(cell_type in cluster_names_by_label for cell_type in pair):
+                raise ClusterPairsException('Invalid cluster pair: {}'.format(cluster_pair),
+                                            'Use one sender{}receiver pair of meta cell types per line'.format(
+                                                separator))
+
+            combinations.add((cluster_names_by_label[pair[0]], cluster_names_by_label[pair[1]]))
+
+        selected_combinations &= combinations
+
+    if not selected_combinations:
+        raise ClusterPairsException('No cluster pairs selected')
+
+    return sorted(selected_combinations)
+
+
 def build_result_matrix(interactions: pd.DataFrame, cluster_interactions: list, separator: str) -> pd.DataFrame:
     """
     builds an empty cluster matrix to fill it later
@@ -176,20 +313,93 @@ def mean_analysis(interactions: pd.DataFrame, clusters: dict, cluster_interactio
 
         results with * are 0 because one of both components is 0.
     """
-    result = base_result.copy()
-
-    for interaction_index, interaction in interactions.iterrows():
-        for cluster_interaction in cluster_interactions:
-            cluster_interaction_string = '{}{}{}'.format(cluster_interaction[0], separator, cluster_interaction[1])
+    receptor_genes, ligand_genes = get_interactions_genes_indexes(interactions, clusters['genes'], suffixes,
+                                                                  counts_data)
+    receptor_clusters, ligand_clusters = get_cluster_interactions_indexes(cluster_interactions, clusters['names'])
 
-            interaction_mean = cluster_interaction_mean(cluster_interaction, interaction, clusters['means'], suffixes,
-                                                        counts_data=counts_data)
+    interactions_means = interactions_cluster_means(clusters['means_table'], receptor_genes, ligand_genes,
+                                                    receptor_clusters, ligand_clusters)
 
-            result.at[interaction_index, cluster_interaction_string] = interaction_mean
+    result = pd.DataFrame(interactions_means, index=base_result.index, columns=base_result.columns)
 
     return result
 
 
+def get_interactions_genes_indexes(interactions: pd.DataFrame, genes: pd.Index, suffixes: tuple = ('_1', '_2'),
+                                   counts_data: str = 'ensembl') -> (np.ndarray, np.ndarray):
+    """
+    Returns the position in genes of the receptor and ligand gene of each interaction
+
+    EXAMPLE:
+        INPUT:
+        interactions
+            ensembl_1   ensembl_2
+        1   ensembl2    ensembl1
+        2   ensembl2    ensembl3
+
+        genes = ['ensembl1', 'ensembl2', 'ensembl3']
+
+        RESULT:
+        ([1, 1], [0, 2])
+
+    Raises KeyError if some interaction gene is not in genes.
+    """
+    receptor_names = interactions['{}{}'.format(counts_data, suffixes[0])]
+    ligand_names = interactions['{}{}'.format(counts_data, suffixes[1])]
+
+    receptor_genes = genes.get_indexer(receptor_names)
+    ligand_genes = genes.get_indexer(ligand_names)
+
+    missing_genes = set(receptor_names[receptor_genes == -1]) | set(ligand_names[ligand_genes == -1])
+    if missing_genes:
+        raise KeyError('Interactions genes not found: {}'.format(', '.join(sorted(map(str, missing_genes)))))
+
+    return receptor_genes, ligand_genes
+
+
+def get_cluster_interactions_indexes(cluster_interactions: list, cluster_names: list) -> (np.ndarray, np.ndarray):
+    """
+    Returns the position of the receptor and ligand cluster of each cluster interaction in cluster_names
+
+    EXAMPLE:
+        INPUT:
+        cluster_interactions = [('cluster1', 'cluster1'), ('cluster1', 'cluster2'), ('cluster2', 'cluster1')]
+        cluster_names = ['cluster2', 'cluster1']
+
+        RESULT:
+        ([1, 1, 0], [1, 0, 1])
+    """
+    cluster_positions = {cluster_name: position for position, cluster_name in enumerate(cluster_names)}
+
+    receptor_clusters = np.array([cluster_positions[cluster_interaction[0]]
+                                  for cluster_interaction in cluster_interactions], dtype=int)
+    ligand_clusters = np.array([cluster_positions[cluster_interaction[1]]
+                                for cluster_interaction in cluster_interactions], dtype=int)
+
+    return receptor_clusters, ligand_clusters
+
+
+def interactions_cluster_means(cluster_means: np.ndarray, receptor_genes: np.ndarray, ligand_genes: np.ndarray,
+                               receptor_clusters: np.ndarray, ligand_clusters: np.ndarray) -> np.ndarray:
+    """
+    Calculates the interactions x cluster interactions matrix of means from a genes x clusters means matrix.
+
+    Each interaction takes the receptor gene mean in the first cluster and the ligand gene mean in the second one.
+    Sets 0 if one of both is 0
+    """
+    receptor_means = cluster_means[np.ix_(receptor_genes, receptor_clusters)]
+    ligand_means = cluster_means[np.ix_(ligand_genes, ligand_clusters)]
+
+    return combine_interaction_means(receptor_means, ligand_means)
+
+
+def combine_interaction_means(receptor_means: np.ndarray, ligand_means: np.ndarray) -> np.ndarray:
+    """
+    Averages the receptor and ligand means. Sets 0 if one of both is 0
+    """
+    return np.where((receptor_means == 0) | (ligand_means == 0), 0, (receptor_means + ligand_means) / 2)
+
+
 def percent_analysis(clusters: dict, threshold: float, interactions: pd.DataFrame, cluster_interactions: list,
                      base_result: pd.DataFrame, separator: str, suffixes: tuple = ('_1', '_2'),
                      counts_data: str = 'ensembl') -> pd.DataFrame:
@@ -230,73 +440,422 @@ def percent_analysis(clusters: dict, threshold: float, interactions: pd.DataFram
 
 
     """
-    result = base_result.copy()
-    percents = {}
-    # percents calculation
-    for cluster_name in clusters['names']:
-        counts = clusters['counts'][cluster_name]
-
-        percents[cluster_name] = counts.apply(lambda count: counts_percent(count, threshold), axis=1)
+    cluster_expressed = clusters['percents_table'] >= threshold
 
-    for interaction_index, interaction in interactions.iterrows():
-        for cluster_interaction in cluster_interactions:
-            cluster_interaction_string = '{}{}{}'.format(cluster_interaction[0], separator, cluster_interaction[1])
+    interactions_percents = interactions_cluster_expressed(cluster_expressed, clusters, interactions,
+                                                           cluster_interactions, suffixes, counts_data)
 
-            interaction_percent = cluster_interaction_percent(cluster_interaction, interaction, percents, suffixes,
-                                                              counts_data=counts_data)
-            result.at[interaction_index, cluster_interaction_string] = interaction_percent
+    result = pd.DataFrame(interactions_percents, index=base_result.index, columns=base_result.columns)
 
     return result
 
 
+def interactions_cluster_expressed(cluster_expressed: np.ndarray, clusters: dict, interactions: pd.DataFrame,
+                                   cluster_interactions: list, suffixes: tuple = ('_1', '_2'),
+                                   counts_data: str = 'ensembl') -> np.ndarray:
+    """
+    Builds the interactions x cluster interactions matrix from a genes x clusters expressed mask:
+    1 if the receptor is expressed in the first cluster and the ligand in the second one, else 0
+    """
+    receptor_genes, ligand_genes = get_interactions_genes_indexes(interactions, clusters['genes'], suffixes,
+                                                                  counts_data)
+    receptor_clusters, ligand_clusters = get_cluster_interactions_indexes(cluster_interactions, clusters['names'])
+
+    receptor_expressed = cluster_expressed[np.ix_(receptor_genes, receptor_clusters)]
+    ligand_expressed = cluster_expressed[np.ix_(ligand_genes, ligand_clusters)]
+
+    return (receptor_expressed & ligand_expressed).astype(int)
+
+
 def shuffled_analysis(iterations: int, meta: pd.DataFrame, counts: pd.DataFrame, interactions: pd.DataFrame,
-                      cluster_interactions: list, base_result: pd.DataFrame, threads: int, separator: str,
-                      suffixes: tuple = ('_1', '_2'), counts_data: str = 'ensembl') -> list:
+                      cluster_interactions: list, real_mean_analysis: pd.DataFrame, threads: int, separator: str,
+                      suffixes: tuple = ('_1', '_2'), counts_data: str = 'ensembl', debug_seed: int = -1,
+                      batch_size: int = 32, max_exceedances: int = 0, testable: np.ndarray = None,
+                      checkpoint_dir: Optional[str] = None, checkpoint_iterations: int = 1000,
+                      resume: bool = False) -> (np.ndarray, np.ndarray):
     """
-    Shuffles meta and calculates the means for each and saves it in a list.
+    Shuffles meta and counts, for each interaction and cluster interaction, how many shuffled means are bigger than
+    the real mean. Returns the number of bigger shuffled means and the number of iterations evaluated for each one.
 
-    Runs it in a multiple threads to run it faster
+    The counts of the unique interactions genes are converted once to a genes x cells matrix and the iterations are
+    split in one block per thread. Each block shuffles the cells clusters and calculates the means in batches of
+    batch_size permutations, keeping only the running count of shuffled means bigger than the real mean. The blocks
+    counts are added as they finish, so the memory used doesn't depend on the number of iterations.
+
+    The counts matrix and the real means are stored once in memory-mapped files that the workers attach on start, so
+    each task only sends the seed, the iterations range and the mask of the cluster interactions to shuffle. Workers
+    read the shared matrix in place while all its genes are running and copy the running genes once, not per task,
+    when they are fewer.
+
+    Only the testable cluster interactions are shuffled (by default the ones with a real mean, see
+    get_testable_mask): the workers calculate the means of their genes only and compare only those entries, so the
+    work is proportional to the testable cells. The others count 0 bigger means in 0 iterations.
+
+    Every iteration is shuffled with a generator spawned from the seed and the iteration number, so a given debug_seed
+    gives the same result with any number of threads. Without debug_seed, the seed is drawn once from the OS entropy.
+
+    With max_exceedances > 0 the pvalues are sequential (Besag & Clifford, 1991): the iterations run in rounds of
+    growing size and a cluster interaction stops being shuffled once max_exceedances shuffled means are bigger than
+    the real one, so its pvalue is clearly high.
+
+    With checkpoint_dir, the iterations run in chunks of checkpoint_iterations and the state of the shuffling (seed,
+    iterations completed, bigger shuffled means counts and running mask) is saved in the directory after each chunk.
+    With resume, the shuffling continues from the saved state and gives the same result as an uninterrupted run.
     """
     core_logger.info('Running Statistical Analysis')
-    with Pool(processes=threads) as pool:
-        statistical_analysis_thread = partial(_statistical_analysis,
-                                              base_result,
-                                              cluster_interactions,
-                                              counts,
-                                              interactions,
-                                              meta,
-                                              separator,
-                                              suffixes,
-                                              counts_data=counts_data
-                                              )
-        results = pool.map(statistical_analysis_thread, range(iterations))
+    cluster_names = meta['cell_type'].drop_duplicates().tolist()
+    cells_clusters = get_cells_clusters(meta, cluster_names)
+
+    interactions_genes, interactions_genes_indexes = np.unique(
+        np.concatenate(get_interactions_genes_indexes(interactions, counts.index, suffixes, counts_data)),
+        return_inverse=True)
+    receptor_genes, ligand_genes = np.split(interactions_genes_indexes, 2)
+    receptor_clusters, ligand_clusters = get_cluster_interactions_indexes(cluster_interactions, cluster_names)
+
+    if testable is None:
+        testable = real_mean_analysis.values != 0
+
+    counts_matrix = np.asfortranarray(counts.iloc[interactions_genes].loc[:, meta.index].values)
+
+    checkpoint_file = os.path.join(checkpoint_dir, 'statistical_analysis_checkpoint.npz') if checkpoint_dir else None
+    fingerprint = get_checkpoint_fingerprint(real_mean_analysis, testable, cells_clusters, counts_matrix,
+                                             interactions_genes_indexes, iterations, batch_size, max_exceedances,
+                                             debug_seed)
+    checkpoint = load_checkpoint(checkpoint_file, fingerprint) if resume else None
+
+    if checkpoint is None:
+        seed = debug_seed if debug_seed >= 0 else np.random.SeedSequence().entropy
+        completed_iterations = 0
+        shuffled_bigger = np.zeros(real_mean_analysis.shape, dtype=int)
+        shuffled_iterations = np.zeros(real_mean_analysis.shape, dtype=int)
+        running = testable.copy()
+    else:
+        seed = checkpoint['seed']
+        completed_iterations = checkpoint['completed_iterations']
+        shuffled_bigger = checkpoint['shuffled_bigger']
+        shuffled_iterations = checkpoint['shuffled_iterations']
+        running = checkpoint['running']
+        core_logger.info('Resuming Statistical Analysis from iteration {}'.format(completed_iterations))
+
+    with tempfile.TemporaryDirectory(prefix='cpdb_') as shared_dir:
+        counts_matrix_file = os.path.join(shared_dir, 'counts_matrix.npy')
+        real_means_file = os.path.join(shared_dir, 'real_means.npy')
+
+        np.save(counts_matrix_file, counts_matrix)
+        np.save(real_means_file, real_mean_analysis.values)
+
+        with Pool(processes=threads,
+                  initializer=_init_statistical_analysis,
+                  initargs=(counts_matrix_file,
+                            real_means_file,
+                            cells_clusters,
+                            len(cluster_names),
+                            receptor_genes,
+                            ligand_genes,
+                            receptor_clusters,
+                            ligand_clusters,
+                            batch_size)) as pool:
+            for round_start, round_stop in get_iterations_rounds(iterations, batch_size, max_exceedances > 0):
+                if round_stop <= completed_iterations:
+                    continue
+
+                if not running.any():
+                    break
+
+                chunk_size = checkpoint_iterations if checkpoint_file else round_stop - round_start
+                chunks = [(chunk_start, min(chunk_start + chunk_size, round_stop))
+                          for chunk_start in range(round_start, round_stop, chunk_size)]
+
+                for chunk_start, chunk_stop in chunks:
+                    chunk_start = max(chunk_start, completed_iterations)
+                    if chunk_start >= chunk_stop:
+                        continue
+
+                    iterations_tasks = [(seed, block[0], block[-1] + 1, running)
+                                        for block in np.array_split(np.arange(chunk_start, chunk_stop), threads)
+                                        if len(block)]
+
+                    for block_shuffled_bigger in pool.imap_unordered(_statistical_analysis, iterations_tasks):
+                        shuffled_bigger += block_shuffled_bigger
+
+                    shuffled_iterations[running] += chunk_stop - chunk_start
+
+                    if max_exceedances > 0 and chunk_stop == round_stop:
+                        running &= shuffled_bigger < max_exceedances
+
+                    if checkpoint_file:
+                        save_checkpoint(checkpoint_file, fingerprint, seed, chunk_stop, shuffled_bigger,
+                                        shuffled_iterations, running)
+
+    if max_exceedances > 0:
+        stopped = (shuffled_iterations > 0) & (shuffled_iterations < iterations)
+        core_logger.info('Sequential pvalues: {} of {} cluster interactions stopped before {} iterations'.format(
+            np.count_nonzero(stopped), np.count_nonzero(testable), iterations))
+
+    return shuffled_bigger, shuffled_iterations
+
+
+def get_iterations_rounds(iterations: int, batch_size: int, sequential: bool) -> list:
+    """
+    Splits the iterations in the rounds checked for sequential stopping: the first one has batch_size iterations and
+    each round doubles the previous one. The rounds don't depend on the threads number. Without sequential stopping
+    all the iterations run in a single round.
+
+    EXAMPLE:
+        INPUT:
+        iterations = 200
+        batch_size = 32
+        sequential = True
+
+        RESULT:
+        [(0, 32), (32, 96), (96, 200)]
+    """
+    if not sequential:
+        return [(0, iterations)]
+
+    rounds = []
+    round_start = 0
+    round_size = batch_size
+    while round_start < iterations:
+        round_stop = min(round_start + round_size, iterations)
+        rounds.append((round_start, round_stop))
+        round_start = round_stop
+        round_size *= 2
+
+    return rounds
+
+
+def get_checkpoint_fingerprint(real_mean_analysis: pd.DataFrame, testable: np.ndarray, cells_clusters: np.ndarray,
+                               counts_matrix: np.ndarray, interactions_genes_indexes: np.ndarray, iterations: int,
+                               batch_size: int, max_exceedances: int, debug_seed: int) -> str:
+    """
+    Identifies the shuffling a checkpoint belongs to: the real means, the cells clusters, the counts the shuffles read
+    (with the interactions genes rows) and the iterations settings
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(np.ascontiguousarray(real_mean_analysis.values, dtype=float).tobytes())
+    fingerprint.update(np.ascontiguousarray(testable, dtype=bool).tobytes())
+    fingerprint.update(np.ascontiguousarray(cells_clusters, dtype=np.int64).tobytes())
+    fingerprint.update(np.ascontiguousarray(counts_matrix, dtype=float).tobytes())
+    fingerprint.update(np.ascontiguousarray(interactions_genes_indexes, dtype=np.int64).tobytes())
+    fingerprint.update('{}|{}|{}|{}|{}|{}'.format(real_mean_analysis.shape, counts_matrix.shape, iterations,
+                                                  batch_size, max_exceedances, debug_seed).encode())
+
+    return fingerprint.hexdigest()
 
-    return results
 
+def save_checkpoint(checkpoint_file: str, fingerprint: str, seed: int, completed_iterations: int,
+                    shuffled_bigger: np.ndarray, shuffled_iterations: np.ndarray, running: np.ndarray) -> None:
+    """
+    Saves the shuffling state. The file is written aside and then renamed, so an interrupted save keeps the previous
+    checkpoint
+    """
+    os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    temporary_file = '{}.tmp'.format(checkpoint_file)
+
+    with open(temporary_file, 'wb') as f:
+        np.savez(f,
+                 fingerprint=fingerprint,
+                 seed=str(seed),
+                 completed_iterations=completed_iterations,
+                 shuffled_bigger=shuffled_bigger,
+                 shuffled_iterations=shuffled_iterations,
+                 running=running)
+
+    os.replace(temporary_file, checkpoint_file)
 
-def _statistical_analysis(base_result, cluster_interactions, counts, interactions, meta, separator, suffixes,
-                          iteration_number, counts_data: str = 'ensembl') -> pd.DataFrame:
+
+def load_checkpoint(checkpoint_file: str, fingerprint: str) -> Optional[dict]:
     """
-    Shuffles meta dataset and calculates calculates the means
+    Loads the shuffling state saved by save_checkpoint. Returns None if there is no checkpoint yet
+
+    :raise CheckpointException: if the checkpoint belongs to another analysis
     """
-    shuffled_meta = shuffle_meta(meta)
-    shuffled_clusters = build_clusters(shuffled_meta, counts)
-    result_mean_analysis = mean_analysis(interactions, shuffled_clusters, cluster_interactions, base_result, separator,
-                                         suffixes, counts_data=counts_data)
-    return result_mean_analysis
+    if not os.path.exists(checkpoint_file):
+        core_logger.warning('No checkpoint found in {}. Starting from the first iteration'.format(checkpoint_file))
+        return None
+
+    with np.load(checkpoint_file) as checkpoint:
+        if str(checkpoint['fingerprint']) != fingerprint:
+            raise CheckpointException('The checkpoint in {} belongs to another analysis'.format(checkpoint_file),
+                                      'Resume with the same inputs and options or remove the checkpoint')
+
+        return {'seed': int(str(checkpoint['seed'])),
+                'completed_iterations': int(checkpoint['completed_iterations']),
+                'shuffled_bigger': checkpoint['shuffled_bigger'],
+                'shuffled_iterations': checkpoint['shuffled_iterations'],
+                'running': checkpoint['running']}
+
+
+_statistical_analysis_data = {}
+
+
+def _init_statistical_analysis(counts_matrix_file: str, real_means_file: str, cells_clusters: np.ndarray,
+                               clusters_number: int, receptor_genes: np.ndarray, ligand_genes: np.ndarray,
+                               receptor_clusters: np.ndarray, ligand_clusters: np.ndarray, batch_size: int) -> None:
+    """
+    Attaches the memory-mapped counts matrix and real means and keeps the analysis data in the worker
+    """
+    _statistical_analysis_data.update({
+        'counts_matrix': np.load(counts_matrix_file, mmap_mode='r'),
+        'real_means': np.load(real_means_file, mmap_mode='r'),
+        'cells_clusters': cells_clusters,
+        'clusters_number': clusters_number,
+        'receptor_genes': receptor_genes,
+        'ligand_genes': ligand_genes,
+        'receptor_clusters': receptor_clusters,
+        'ligand_clusters': ligand_clusters,
+        'batch_size': batch_size,
+        'running_genes': None,
+        'running_counts_matrix': None,
+    })
+
+
+def _get_running_counts_matrix(genes: np.ndarray) -> np.ndarray:
+    """
+    Returns the counts of the given genes (sorted positions in the memory-mapped matrix) for the worker.
+
+    If all the genes are running, the memory-mapped matrix is used as is and its pages are shared with the other
+    workers. Otherwise the counts of the genes are copied once and reused by the next tasks of the worker, until the
+    running genes change.
+    """
+    data = _statistical_analysis_data
+
+    if len(genes) == data['counts_matrix'].shape[0]:
+        return data['counts_matrix']
+
+    if data['running_genes'] is None or not np.array_equal(data['running_genes'], genes):
+        data['running_genes'] = genes
+        data['running_counts_matrix'] = np.asfortranarray(data['counts_matrix'][genes])
+
+    return data['running_counts_matrix']
+
+
+def _statistical_analysis(iterations_task: tuple) -> np.ndarray:
+    """
+    Shuffles the cells clusters for a range of iterations and counts how many shuffled means are bigger than the real
+
+    Only the cluster interactions in the task running mask are evaluated, with the counts of their genes (see
+    _get_running_counts_matrix), and the others count 0.
+    """
+    seed, iterations_start, iterations_stop, running = iterations_task
+    data = _statistical_analysis_data
+
+    interactions_indexes, cluster_interactions_indexes = np.nonzero(running)
+
+    genes, cells_genes = np.unique(np.concatenate([data['receptor_genes'][interactions_indexes],
+                                                   data['ligand_genes'][interactions_indexes]]), return_inverse=True)
+    receptor_genes, ligand_genes = np.split(cells_genes, 2)
+    receptor_clusters = data['receptor_clusters'][cluster_interactions_indexes]
+    ligand_clusters = data['ligand_clusters'][cluster_interactions_indexes]
+
+    counts_matrix = _get_running_counts_matrix(genes)
+    real_means = data['real_means'][interactions_indexes, cluster_interactions_indexes]
+
+    cells_shuffled_bigger = np.zeros(len(real_means), dtype=int)
+
+    for batch_start in range(iterations_start, iterations_stop, data['batch_size']):
+        batch_stop = min(batch_start + data['batch_size'], iterations_stop)
+        shuffled_cells_clusters = np.array([shuffle_cells_clusters(data['cells_clusters'], seed, iteration)
+                                            for iteration in range(batch_start, batch_stop)])
+
+        for shuffled_clusters_means in build_clusters_means(counts_matrix, shuffled_cells_clusters,
+                                                            data['clusters_number']):
+            shuffled_means = combine_interaction_means(shuffled_clusters_means[receptor_genes, receptor_clusters],
+                                                       shuffled_clusters_means[ligand_genes, ligand_clusters])
+            cells_shuffled_bigger += shuffled_means > real_means
+
+    shuffled_bigger = np.zeros(running.shape, dtype=int)
+    shuffled_bigger[interactions_indexes, cluster_interactions_indexes] = cells_shuffled_bigger
+
+    return shuffled_bigger
+
+
+def approximate_analysis(meta: pd.DataFrame, counts: pd.DataFrame, interactions: pd.DataFrame,
+                         cluster_interactions: list, real_mean_analysis: pd.DataFrame, suffixes: tuple = ('_1', '_2'),
+                         counts_data: str = 'ensembl', testable: np.ndarray = None,
+                         interactions_block: int = 256) -> np.ndarray:
+    """
+    Approximates, without shuffling, the fraction of shuffled means bigger than the real mean of each interaction and
+    cluster interaction.
+
+    Shuffling the cells clusters, the mean of a gene in a cluster of n cells is the mean of a sample without
+    replacement of the N cells, with the gene mean (mu) as expectation and variance var * (N - n) / (n * (N - 1)),
+    where var is the gene variance over all the cells. The receptor and ligand means are correlated: in the same
+    cluster their covariance is cov * (N - n) / (n * (N - 1)) and in two different clusters -cov / (N - 1), where cov
+    is the covariance of both genes over all the cells. The interaction mean (the average of both) is approximated by
+    a gamma distribution with that expectation and variance (counts are not negative) and the result is the
+    probability of a value bigger than the real mean. The means set to 0 by combine_interaction_means are ignored.
+
+    The genes covariances are calculated in blocks of interactions_block interactions. Only the testable cluster
+    interactions (by default the ones with a real mean) are approximated, the others are 0.
+    """
+    core_logger.info('Running Approximate Statistical Analysis')
+    cluster_names = meta['cell_type'].drop_duplicates().tolist()
+    cells_clusters = get_cells_clusters(meta, cluster_names)
+
+    receptor_genes, ligand_genes = get_interactions_genes_indexes(interactions, counts.index, suffixes, counts_data)
+    receptor_clusters, ligand_clusters = get_cluster_interactions_indexes(cluster_interactions, cluster_names)
+
+    if testable is None:
+        testable = real_mean_analysis.values != 0
+
+    counts_matrix = counts.loc[:, meta.index].values
+    cells_number = counts_matrix.shape[1]
+    genes_means = counts_matrix.mean(axis=1)
+    genes_variances = counts_matrix.var(axis=1)
+
+    interactions_covariances = np.empty(len(receptor_genes))
+    for block_start in range(0, len(receptor_genes), interactions_block):
+        block = slice(block_start, block_start + interactions_block)
+        interactions_covariances[block] = np.einsum('ij,ij->i', counts_matrix[receptor_genes[block]],
+                                                    counts_matrix[ligand_genes[block]]) / cells_number
+    interactions_covariances -= genes_means[receptor_genes] * genes_means[ligand_genes]
+
+    clusters_sizes = np.bincount(cells_clusters, minlength=len(cluster_names))
+    clusters_factors = (cells_number - clusters_sizes) / (np.maximum(clusters_sizes, 1) * max(cells_number - 1, 1))
+
+    receptor_variances = genes_variances[receptor_genes][:, np.newaxis] * clusters_factors[receptor_clusters]
+    ligand_variances = genes_variances[ligand_genes][:, np.newaxis] * clusters_factors[ligand_clusters]
+    covariances = interactions_covariances[:, np.newaxis] * np.where(receptor_clusters == ligand_clusters,
+                                                                     clusters_factors[receptor_clusters],
+                                                                     -1 / max(cells_number - 1, 1))
+
+    expected_means = np.broadcast_to(((genes_means[receptor_genes] + genes_means[ligand_genes]) / 2)[:, np.newaxis],
+                                     real_mean_analysis.shape)[testable]
+    variances = np.maximum((receptor_variances + ligand_variances + 2 * covariances) / 4, 0)[testable]
+    real_means = real_mean_analysis.values[testable]
+
+    shuffled_bigger = (expected_means > real_means).astype(float)
+    approximable = (expected_means > 0) & (variances > 0)
+    shuffled_bigger[approximable] = stats.gamma.sf(real_means[approximable],
+                                                   expected_means[approximable] ** 2 / variances[approximable],
+                                                   scale=variances[approximable] / expected_means[approximable])
+
+    result = np.zeros(real_mean_analysis.shape)
+    result[testable] = shuffled_bigger
+
+    return result
+
+
+def get_testable_mask(real_mean_analysis: pd.DataFrame, real_percents_analysis: pd.DataFrame) -> np.ndarray:
+    """
+    Returns the interactions x cluster interactions mask of the pvalues that depend on the shuffling: the ones with a
+    real mean and a real percent. The others are always 1
+    """
+    return (real_percents_analysis.values.astype(int) != 0) & (real_mean_analysis.values != 0)
 
 
 def build_percent_result(real_mean_analysis: pd.DataFrame, real_perecents_analysis: pd.DataFrame,
-                         statistical_mean_analysis: list, interactions: pd.DataFrame, cluster_interactions: list,
-                         base_result: pd.DataFrame, separator: str) -> pd.DataFrame:
+                         shuffled_bigger: np.ndarray, iterations: Union[int, np.ndarray]) -> pd.DataFrame:
     """
     Calculates the pvalues after statistical analysis.
 
     If real_percent or real_mean are zero, result_percent is 1
 
     If not:
-    Calculates how many shuffled means are bigger than real mean and divides it for the number of
-    the total iterations
+    Divides the number of shuffled means bigger than the real mean by the number of the total iterations, or by the
+    iterations evaluated for each cluster interaction if they stopped early
 
     EXAMPLE:
         INPUT:
@@ -312,17 +871,10 @@ def build_percent_result(real_mean_analysis: pd.DataFrame, real_perecents_analys
         interaction1  1                   0
         interaction2  0                   1
 
-        statistical means:
-        [
-                        cluster1_cluster1   cluster1_cluster2 ...
-        interaction1    0.6                 0.1
-        interaction2    0.0                 0.2
-
-        ,
+        shuffled_bigger:
                       cluster1_cluster1   cluster1_cluster2 ...
-        interaction1  0.5                 0.4
-        interaction2  0.0                 0.6
-        ]
+        interaction1  1                   0
+        interaction2  0                   1
 
         iterations = 2
 
@@ -330,36 +882,16 @@ def build_percent_result(real_mean_analysis: pd.DataFrame, real_perecents_analys
         RESULT:
 
                         cluster1_cluster1   cluster1_cluster2 ...
-        interaction1    1                   1
+        interaction1    0.5                 1
         interaction2    1                   0.5
 
 
     """
     core_logger.info('Building Pvalues result')
-    percent_result = base_result.copy()
-
-    for interaction_index, interaction in interactions.iterrows():
-        for cluster_interaction in cluster_interactions:
-            cluster_interaction_string = '{}{}{}'.format(cluster_interaction[0], separator, cluster_interaction[1])
-            real_mean = real_mean_analysis.at[interaction_index, cluster_interaction_string]
-            real_percent = real_perecents_analysis.at[interaction_index, cluster_interaction_string]
-
-            if int(real_percent) == 0 or real_mean == 0:
-                result_percent = 1.0
-
-            else:
-                shuffled_bigger = 0
-
-                for statistical_mean in statistical_mean_analysis:
-                    mean = statistical_mean.at[interaction_index, cluster_interaction_string]
-                    if mean > real_mean:
-                        shuffled_bigger += 1
+    percent_result = np.where(get_testable_mask(real_mean_analysis, real_perecents_analysis),
+                              shuffled_bigger / np.maximum(iterations, 1), 1.0)
 
-                result_percent = shuffled_bigger / len(statistical_mean_analysis)
-
-            percent_result.at[interaction_index, cluster_interaction_string] = result_percent
-
-    return percent_result
+    return pd.DataFrame(percent_result, index=real_mean_analysis.index, columns=real_mean_analysis.columns)
 
 
 def interacting_pair_build(interactions: pd.DataFrame) -> pd.Series:
@@ -391,85 +923,12 @@ def build_significant_means(real_mean_analysis: pd.DataFrame, result_percent: pd
     significant_means = get_significant_means(real_mean_analysis, result_percent, min_significant_mean)
     significant_mean_rank = significant_means.count(axis=1)  # type: pd.Series
     number_of_clusters = len(significant_means.columns)
-    significant_mean_rank = significant_mean_rank.apply(lambda rank: rank / number_of_clusters)
+    significant_mean_rank = significant_mean_rank / number_of_clusters
     significant_mean_rank = significant_mean_rank.round(3)
     significant_mean_rank.name = 'rank'
     return significant_mean_rank, significant_means
 
 
-def cluster_interaction_percent(cluster_interaction: tuple,
-                                interaction: pd.Series,
-                                clusters_percents: dict,
-                                suffixes: tuple = ('_1', '_2'),
-                                counts_data: str = 'ensembl'
-                                ) -> int:
-    """
-    If one of both is not 0 the result is 0 other cases are 1
-    """
-
-    percent_cluster_receptors = clusters_percents[cluster_interaction[0]]
-    percent_cluster_ligands = clusters_percents[cluster_interaction[1]]
-
-    percent_receptor = percent_cluster_receptors[interaction['{}{}'.format(counts_data, suffixes[0])]]
-    percent_ligand = percent_cluster_ligands[interaction['{}{}'.format(counts_data, suffixes[1])]]
-
-    if percent_receptor or percent_ligand:
-        interaction_percent = 0
-
-    else:
-        interaction_percent = 1
-
-    return interaction_percent
-
-
-def counts_percent(counts: pd.Series, threshold: float) -> int:
-    """
-    Calculates the number of positive values and divides it for the total.
-    If this value is < threshold, returns 1, else, returns 0
-
-
-    EXAMPLE:
-        INPUT:
-        counts = [0.1, 0.2, 0.3, 0.0]
-        threshold = 0.1
-
-        RESULT:
-
-        # 3/4 -> 0.75 not minor than 0.1
-        result = 0
-    """
-    total = len(counts)
-    positive = len(counts[counts > 0])
-
-    if positive / total < threshold:
-        return 1
-    else:
-        return 0
-
-
-def cluster_interaction_mean(cluster_interaction: tuple, interaction: pd.Series, clusters_means: dict,
-                             suffixes: tuple = ('_1', '_2'), counts_data: str = 'ensembl') -> float:
-    """
-    Calculates the mean value for two clusters.
-
-    Set 0 if one of both is 0
-    """
-
-    means_cluster_receptors = clusters_means[cluster_interaction[0]]
-    means_cluster_ligands = clusters_means[cluster_interaction[1]]
-
-    receptor = interaction['{}{}'.format(counts_data, suffixes[0])]
-    mean_receptor = means_cluster_receptors[receptor]
-    mean_ligand = means_cluster_ligands[interaction['{}{}'.format(counts_data, suffixes[1])]]
-
-    if mean_receptor == 0 or mean_ligand == 0:
-        interaction_mean = 0
-    else:
-        interaction_mean = (mean_receptor + mean_ligand) / 2
-
-    return interaction_mean
-
-
 def filter_interactions_by_counts(interactions: pd.DataFrame, counts: pd.DataFrame,
                                   suffixes: tuple = ('_1', '_2'), counts_data: str = 'ensembl') -> pd.DataFrame:
     """
@@ -1,8 +1,12 @@
+from typing import Optional
+
 import pandas as pd
 
+from cellphonedb.src.core.core_logger import core_logger
 from cellphonedb.src.core.exceptions.EmptyResultException import EmptyResultException
 from cellphonedb.src.core.methods import cpdb_statistical_analysis_simple_method, \
-    cpdb_statistical_analysis_complex_method
+    cpdb_statistical_analysis_complex_method, cpdb_statistical_analysis_helper
+from cellphonedb.src.core.utils.profiler import Profiler
 
 
 def call(meta: pd.DataFrame,
@@ -18,38 +22,161 @@ def call(meta: pd.DataFrame,
          debug_seed: int,
          result_precision: int,
          pvalue: float,
-         separator: str
+         separator: str,
+         max_exceedances: int = 0,
+         cluster_pairs: Optional[list] = None,
+         checkpoint_dir: Optional[str] = None,
+         checkpoint_iterations: int = 1000,
+         resume: bool = False,
+         profiler: Optional[Profiler] = None,
+         pvalue_method: str = 'permutation'
          ) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame):
-    pvalues_simple, means_simple, significant_means_simple, deconvoluted_simple = \
-        cpdb_statistical_analysis_simple_method.call(meta.copy(),
-                                                     count.copy(),
-                                                     counts_data,
-                                                     interactions,
-                                                     pvalue,
-                                                     separator,
-                                                     iterations,
-                                                     threshold,
-                                                     threads,
-                                                     debug_seed,
-                                                     result_precision,
-                                                     )
-
-    pvalues_complex, means_complex, significant_means_complex, deconvoluted_complex = \
-        cpdb_statistical_analysis_complex_method.call(meta.copy(),
-                                                      count.copy(),
-                                                      counts_data,
-                                                      interactions,
-                                                      genes,
-                                                      complex_expanded,
-                                                      complex_composition,
-                                                      pvalue,
-                                                      separator,
-                                                      iterations,
-                                                      threshold,
-                                                      threads,
-                                                      debug_seed,
-                                                      result_precision,
-                                                      )
+    """
+    Runs the simple and complex statistical analysis in a single pass: the interactions of both (with the complexes
+    replaced by their most significative gene) are joined in one table over one counts matrix, so the real analysis
+    and the shuffles are calculated once. The results are split back to build the simple and complex documents.
+
+    With pvalue_method 'approximate', the pvalues are approximated from the counts moments instead of shuffling (see
+    cpdb_statistical_analysis_helper.approximate_analysis) and iterations, threads and the checkpoints are not used.
+
+    The stages are recorded in profiler, if it is set.
+    """
+    profiler = profiler or Profiler()
+
+    core_logger.info(
+        '[Cluster Statistical Analysis] '
+        'Threshold:{} Iterations:{} Debug-seed:{} Threads:{} Precision:{} Max-exceedances:{} Pvalue-method:{}'.format(
+            threshold, iterations, debug_seed, threads, result_precision, max_exceedances, pvalue_method))
+
+    if debug_seed >= 0:
+        core_logger.warning('Debug random seed enabled. Setted to {}'.format(debug_seed))
+
+    with profiler.stage('prefilters'):
+        interactions_simple, counts_simple = cpdb_statistical_analysis_simple_method.prefilters(count, interactions,
+                                                                                                counts_data)
+        if counts_simple.empty:
+            interactions_simple = interactions_simple.iloc[0:0]
+
+        interactions_complex, counts_complex, complex_in_counts = cpdb_statistical_analysis_complex_method.prefilters(
+            interactions, count, genes, complex_expanded, complex_composition, counts_data)
+
+        if interactions_complex.empty:
+            interactions_complex_processed = pd.DataFrame(columns=['{}_1'.format(counts_data),
+                                                                   '{}_2'.format(counts_data)])
+        else:
+            complex_significative_protein = cpdb_statistical_analysis_complex_method.get_complex_significative(
+                complex_in_counts, counts_complex, complex_composition, sorted(count.columns))
+            interactions_complex_processed = cpdb_statistical_analysis_complex_method.get_interactions_processed(
+                interactions_complex, complex_significative_protein, counts_data=counts_data)
+
+    if interactions_simple.empty and interactions_complex.empty:
+        raise EmptyResultException
+
+    counts_filtered = build_counts(meta, [counts_simple, counts_complex])
+
+    with profiler.stage('build_clusters'):
+        clusters = cpdb_statistical_analysis_helper.build_clusters(meta, counts_filtered)
+    core_logger.info('Running Real Analysis')
+    cluster_interactions = cpdb_statistical_analysis_helper.get_cluster_combinations(clusters['names'],
+                                                                                     cluster_pairs)
+
+    gene_columns = ['{}_1'.format(counts_data), '{}_2'.format(counts_data)]
+    interactions_analysis = pd.concat([interactions_simple[gene_columns], interactions_complex_processed[gene_columns]],
+                                      ignore_index=True)
+
+    profiler.set_dimensions(cells=len(meta), genes=len(counts_filtered), interactions=len(interactions_analysis),
+                            cluster_pairs=len(cluster_interactions), iterations=iterations, threads=threads)
+
+    with profiler.stage('real_analysis'):
+        base_result = cpdb_statistical_analysis_helper.build_result_matrix(interactions_analysis,
+                                                                           cluster_interactions,
+                                                                           separator)
+
+        real_mean_analysis = cpdb_statistical_analysis_helper.mean_analysis(interactions_analysis,
+                                                                            clusters,
+                                                                            cluster_interactions,
+                                                                            base_result,
+                                                                            separator,
+                                                                            counts_data=counts_data)
+
+        real_percent_analysis = cpdb_statistical_analysis_helper.percent_analysis(clusters,
+                                                                                  threshold,
+                                                                                  interactions_analysis,
+                                                                                  cluster_interactions,
+                                                                                  base_result,
+                                                                                  separator,
+                                                                                  counts_data=counts_data)
+
+    testable = cpdb_statistical_analysis_helper.get_testable_mask(real_mean_analysis, real_percent_analysis)
+
+    if pvalue_method == 'approximate':
+        with profiler.stage('approximate_analysis'):
+            # The approximated fraction of bigger shuffled means is the pvalue itself, as if from a single iteration
+            shuffled_bigger = cpdb_statistical_analysis_helper.approximate_analysis(meta,
+                                                                                    counts_filtered,
+                                                                                    interactions_analysis,
+                                                                                    cluster_interactions,
+                                                                                    real_mean_analysis,
+                                                                                    counts_data=counts_data,
+                                                                                    testable=testable)
+            shuffled_iterations = 1
+    else:
+        with profiler.stage('shuffled_analysis'):
+            shuffled_bigger, shuffled_iterations = cpdb_statistical_analysis_helper.shuffled_analysis(
+                iterations,
+                meta,
+                counts_filtered,
+                interactions_analysis,
+                cluster_interactions,
+                real_mean_analysis,
+                threads,
+                separator,
+                counts_data=counts_data,
+                debug_seed=debug_seed,
+                max_exceedances=max_exceedances,
+                testable=testable,
+                checkpoint_dir=checkpoint_dir,
+                checkpoint_iterations=checkpoint_iterations,
+                resume=resume
+            )
+
+    with profiler.stage('build_results'):
+        result_percent = cpdb_statistical_analysis_helper.build_percent_result(real_mean_analysis,
+                                                                               real_percent_analysis,
+                                                                               shuffled_bigger,
+                                                                               shuffled_iterations)
+
+        real_mean_simple, real_mean_complex = split_interactions_result(real_mean_analysis, interactions_simple,
+                                                                        interactions_complex_processed)
+        result_percent_simple, result_percent_complex = split_interactions_result(result_percent, interactions_simple,
+                                                                                  interactions_complex_processed)
+
+        pvalues_simple, means_simple, significant_means_simple, deconvoluted_simple = \
+            pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+        if not interactions_simple.empty:
+            pvalues_simple, means_simple, significant_means_simple, deconvoluted_simple = \
+                cpdb_statistical_analysis_simple_method.build_results(interactions_simple,
+                                                                      real_mean_simple,
+                                                                      result_percent_simple,
+                                                                      dict(clusters['means']),
+                                                                      result_precision,
+                                                                      pvalue,
+                                                                      counts_data)
+
+        pvalues_complex, means_complex, significant_means_complex, deconvoluted_complex = \
+            pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+        if not interactions_complex.empty:
+            pvalues_complex, means_complex, significant_means_complex, deconvoluted_complex = \
+                cpdb_statistical_analysis_complex_method.build_results(interactions_complex,
+                                                                       real_mean_complex,
+                                                                       result_percent_complex,
+                                                                       dict(clusters['means']),
+                                                                       complex_composition,
+                                                                       count,
+                                                                       genes,
+                                                                       result_precision,
+                                                                       pvalue,
+                                                                       counts_data)
 
     pvalues = pvalues_simple.append(pvalues_complex, sort=False)
     means = means_simple.append(means_complex, sort=False)
@@ -66,3 +193,28 @@ def call(meta: pd.DataFrame,
     deconvoluted.drop_duplicates(inplace=True)
 
     return deconvoluted, means, pvalues, significant_means
+
+
+def build_counts(meta: pd.DataFrame, counts_list: list) -> pd.DataFrame:
+    """
+    Joins the filtered counts of the simple and complex analysis in a single genes x cells table, keeping the first
+    row of the genes in both
+    """
+    counts = pd.concat([counts.loc[:, meta.index] for counts in counts_list if not counts.empty], sort=False)
+
+    return counts[~counts.index.duplicated()].astype(float)
+
+
+def split_interactions_result(result: pd.DataFrame, interactions_simple: pd.DataFrame,
+                              interactions_complex: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Splits a result of the joined simple and complex interactions, giving back to each part its interactions index
+    """
+    simple_size = len(interactions_simple)
+
+    result_simple = pd.DataFrame(result.values[:simple_size], index=interactions_simple.index,
+                                 columns=result.columns)
+    result_complex = pd.DataFrame(result.values[simple_size:], index=interactions_complex.index,
+                                  columns=result.columns)
+
+    return result_simple, result_complex
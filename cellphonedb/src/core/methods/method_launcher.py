@@ -1,10 +1,18 @@
+from typing import Union, Optional, Iterable
+
 import pandas as pd
 
 from cellphonedb.src.core.core_logger import core_logger
 from cellphonedb.src.core.database import DatabaseManager
+from cellphonedb.src.core.exceptions.CheckpointException import CheckpointException
+from cellphonedb.src.core.exceptions.PvalueMethodException import PvalueMethodException
 from cellphonedb.src.core.exceptions.ThresholdValueException import ThresholdValueException
-from cellphonedb.src.core.methods import cpdb_analysis_method, cpdb_statistical_analysis_method
+from cellphonedb.src.core.methods import cpdb_analysis_method, cpdb_statistical_analysis_method, \
+    cpdb_statistical_analysis_helper
 from cellphonedb.src.core.preprocessors import method_preprocessors
+from cellphonedb.src.core.utils.counts_summary import CountsSummary
+from cellphonedb.src.core.utils.profiler import Profiler
+from cellphonedb.src.core.utils.sparse_counts import SparseCounts
 from cellphonedb.src.core.utils.subsampler import Subsampler
 from cellphonedb.src.exceptions.ParseCountsException import ParseCountsException
 
@@ -26,9 +34,45 @@ class MethodLauncher:
         multidatas = self.database_manager.get_repository('multidata').get_multidatas_from_string(string)
         return multidatas
 
+    def get_interacting_genes(self, counts_data: str, interactions_filter: Optional[dict] = None) -> list:
+        """
+        Returns the genes of the proteins involved in the database interactions, directly or as complex components.
+        If interactions_filter is set, only the interactions selected by it are used
+        """
+        interactions = self.database_manager.get_repository('interaction').get_all(interactions_filter)
+        genes = self.database_manager.get_repository('gene').get_all_expanded()
+        complex_composition = self.database_manager.get_repository('complex').get_all_compositions()
+
+        multidata_ids = interactions['multidata_1_id'].append(interactions['multidata_2_id'])
+        complex_components_ids = complex_composition[complex_composition['complex_multidata_id'].isin(multidata_ids)][
+            'protein_multidata_id']
+
+        interacting_genes = genes[genes['id_multidata'].isin(multidata_ids.append(complex_components_ids))]
+
+        return interacting_genes[counts_data].drop_duplicates().tolist()
+
+    def get_complexes_components(self, counts_data: str) -> pd.DataFrame:
+        """
+        Returns the components of the database complexes: one row for each complex name ('complex'), component protein
+        ('protein') and component gene ('gene')
+        """
+        genes = self.database_manager.get_repository('gene').get_all_expanded()
+        complex_composition = self.database_manager.get_repository('complex').get_all_compositions()
+        complex_expanded = self.database_manager.get_repository('complex').get_all_expanded()
+
+        complexes_components = pd.merge(complex_composition, complex_expanded[['complex_multidata_id', 'name']],
+                                        on='complex_multidata_id')
+        complexes_components = pd.merge(complexes_components, genes[['id_multidata', counts_data]],
+                                        left_on='protein_multidata_id', right_on='id_multidata')
+
+        complexes_components = complexes_components[['name', 'protein_multidata_id', counts_data]]
+        complexes_components.columns = ['complex', 'protein', 'gene']
+
+        return complexes_components.drop_duplicates().reset_index(drop=True)
+
     def cpdb_statistical_analysis_launcher(self,
                                            raw_meta: pd.DataFrame,
-                                           counts: pd.DataFrame,
+                                           counts: Union[pd.DataFrame, SparseCounts],
                                            counts_data: str,
                                            iterations: int,
                                            threshold: float,
@@ -37,6 +81,15 @@ class MethodLauncher:
                                            result_precision: int,
                                            pvalue: float,
                                            subsampler: Subsampler = None,
+                                           max_exceedances: int = 0,
+                                           cell_types: Optional[list] = None,
+                                           cluster_pairs: Optional[list] = None,
+                                           interactions_filter: Optional[dict] = None,
+                                           checkpoint_dir: Optional[str] = None,
+                                           checkpoint_iterations: int = 1000,
+                                           resume: bool = False,
+                                           profiler: Optional[Profiler] = None,
+                                           pvalue_method: str = 'permutation',
                                            ) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame):
 
         if threads < 1:
@@ -46,17 +99,40 @@ class MethodLauncher:
         if threshold < 0 or threshold > 1:
             raise ThresholdValueException(threshold)
 
-        meta = method_preprocessors.meta_preprocessor(raw_meta)
-        counts = self._counts_validations(counts, meta)
+        if resume and not checkpoint_dir:
+            raise CheckpointException('No checkpoint directory to resume from', 'Set the checkpoint directory')
 
-        if subsampler is not None:
-            counts = subsampler.subsample(counts)
-            meta = meta.filter(items=(list(counts)), axis=0)
+        if checkpoint_iterations < 1:
+            raise CheckpointException('Checkpoint iterations must be a positive number')
 
-        interactions = self.database_manager.get_repository('interaction').get_all_expanded()
-        genes = self.database_manager.get_repository('gene').get_all_expanded()
-        complex_composition = self.database_manager.get_repository('complex').get_all_compositions()
-        complex_expanded = self.database_manager.get_repository('complex').get_all_expanded()
+        if pvalue_method not in ('permutation', 'approximate'):
+            raise PvalueMethodException(pvalue_method)
+
+        profiler = profiler or Profiler()
+
+        with profiler.stage('preprocessing'):
+            meta = method_preprocessors.meta_preprocessor(raw_meta)
+            counts = self._counts_validations(counts, meta)
+
+            if subsampler is not None:
+                counts = subsampler.subsample(counts)
+                meta = meta.filter(items=list(counts.columns), axis=0)
+
+            if isinstance(counts, SparseCounts):
+                # Only the interacting genes are converted to dense: the prefilters and the analysis use DataFrames
+                interacting_genes = self.get_interacting_genes(counts_data, interactions_filter)
+                counts = counts.filter_genes(interacting_genes).to_dataframe()
+
+            cluster_pairs = cpdb_statistical_analysis_helper.select_cluster_pairs(
+                meta['cell_type'].drop_duplicates().tolist(), cell_types, cluster_pairs, self.separator)
+
+            interactions = self.database_manager.get_repository('interaction').get_all_expanded(
+                interactions_filter=interactions_filter)
+            genes = self.database_manager.get_repository('gene').get_all_expanded()
+            complex_composition = self.database_manager.get_repository('complex').get_all_compositions()
+            complex_expanded = self.database_manager.get_repository('complex').get_all_expanded()
+
+        profiler.set_dimensions(cells=len(meta), input_genes=len(counts))
 
         deconvoluted, means, pvalues, significant_means = \
             cpdb_statistical_analysis_method.call(meta,
@@ -72,33 +148,59 @@ class MethodLauncher:
                                                   debug_seed,
                                                   result_precision,
                                                   pvalue,
-                                                  self.separator)
+                                                  self.separator,
+                                                  max_exceedances,
+                                                  cluster_pairs,
+                                                  checkpoint_dir,
+                                                  checkpoint_iterations,
+                                                  resume,
+                                                  profiler,
+                                                  pvalue_method)
 
         return pvalues, means, significant_means, deconvoluted
 
     def cpdb_method_analysis_launcher(self,
                                       raw_meta: pd.DataFrame,
-                                      counts: pd.DataFrame,
+                                      counts: Union[pd.DataFrame, SparseCounts],
                                       counts_data: str,
                                       threshold: float,
                                       result_precision: int,
                                       subsampler: Subsampler = None,
+                                      cell_types: Optional[list] = None,
+                                      cluster_pairs: Optional[list] = None,
+                                      interactions_filter: Optional[dict] = None,
+                                      profiler: Optional[Profiler] = None,
                                       ) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
 
         if threshold < 0 or threshold > 1:
             raise ThresholdValueException(threshold)
-        meta = method_preprocessors.meta_preprocessor(raw_meta)
 
-        counts = self._counts_validations(counts, meta)
+        profiler = profiler or Profiler()
 
-        if subsampler is not None:
-            counts = subsampler.subsample(counts)
-            meta = meta.filter(items=list(counts), axis=0)
+        with profiler.stage('preprocessing'):
+            meta = method_preprocessors.meta_preprocessor(raw_meta)
 
-        interactions = self.database_manager.get_repository('interaction').get_all_expanded()
-        genes = self.database_manager.get_repository('gene').get_all_expanded()
-        complex_composition = self.database_manager.get_repository('complex').get_all_compositions()
-        complex_expanded = self.database_manager.get_repository('complex').get_all_expanded()
+            counts = self._counts_validations(counts, meta)
+
+            if subsampler is not None:
+                counts = subsampler.subsample(counts)
+                meta = meta.filter(items=list(counts.columns), axis=0)
+
+            if isinstance(counts, SparseCounts):
+                # Only the interacting genes are converted to dense: the prefilters and the analysis use DataFrames
+                interacting_genes = self.get_interacting_genes(counts_data, interactions_filter)
+                counts = counts.filter_genes(interacting_genes).to_dataframe()
+
+            cluster_pairs = cpdb_statistical_analysis_helper.select_cluster_pairs(
+                meta['cell_type'].drop_duplicates().tolist(), cell_types, cluster_pairs, self.separator)
+
+            interactions = self.database_manager.get_repository('interaction').get_all_expanded(
+                interactions_filter=interactions_filter)
+            genes = self.database_manager.get_repository('gene').get_all_expanded()
+            complex_composition = self.database_manager.get_repository('complex').get_all_compositions()
+            complex_expanded = self.database_manager.get_repository('complex').get_all_expanded()
+
+        profiler.set_dimensions(cells=len(meta), input_genes=len(counts))
 
         means, significant_means, deconvoluted = cpdb_analysis_method.call(
             meta,
@@ -110,21 +212,86 @@ class MethodLauncher:
             complex_composition,
             self.separator,
             threshold,
-            result_precision)
+            result_precision,
+            cluster_pairs,
+            profiler)
+
+        return means, significant_means, deconvoluted
+
+    def cpdb_summarize_launcher(self,
+                                raw_meta: pd.DataFrame,
+                                counts_chunks: Iterable[Union[pd.DataFrame, SparseCounts]],
+                                counts_data: str,
+                                ) -> CountsSummary:
+        """
+        Summarizes the counts chunks by cell type. Only the genes involved in the database interactions are kept.
+        """
+        meta = method_preprocessors.meta_preprocessor(raw_meta)
+        meta.index = meta.index.astype(str)
+
+        interacting_genes = self.get_interacting_genes(counts_data)
+        interacting_chunks = (chunk.filter_genes(interacting_genes) if isinstance(chunk, SparseCounts) else
+                              chunk[chunk.index.isin(interacting_genes)] for chunk in counts_chunks)
+
+        return CountsSummary.from_counts_chunks(meta, interacting_chunks, self.get_complexes_components(counts_data))
+
+    def cpdb_method_analysis_summary_launcher(self,
+                                              summary: CountsSummary,
+                                              counts_data: str,
+                                              threshold: float,
+                                              result_precision: int,
+                                              cell_types: Optional[list] = None,
+                                              cluster_pairs: Optional[list] = None,
+                                              interactions_filter: Optional[dict] = None,
+                                              profiler: Optional[Profiler] = None,
+                                              ) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
+
+        if threshold < 0 or threshold > 1:
+            raise ThresholdValueException(threshold)
+
+        profiler = profiler or Profiler()
+
+        with profiler.stage('preprocessing'):
+            cluster_pairs = cpdb_statistical_analysis_helper.select_cluster_pairs(
+                summary.cell_types, cell_types, cluster_pairs, self.separator)
+
+            interactions = self.database_manager.get_repository('interaction').get_all_expanded(
+                interactions_filter=interactions_filter)
+            genes = self.database_manager.get_repository('gene').get_all_expanded()
+            complex_composition = self.database_manager.get_repository('complex').get_all_compositions()
+            complex_expanded = self.database_manager.get_repository('complex').get_all_expanded()
+
+        profiler.set_dimensions(cells=summary.cells.sum(), input_genes=len(summary.genes))
+
+        means, significant_means, deconvoluted = cpdb_analysis_method.call(
+            None,
+            summary.to_counts(),
+            counts_data,
+            interactions,
+            genes,
+            complex_expanded,
+            complex_composition,
+            self.separator,
+            threshold,
+            result_precision,
+            cluster_pairs,
+            profiler,
+            summary)
 
         return means, significant_means, deconvoluted
 
     @staticmethod
-    def _counts_validations(counts: pd.DataFrame, meta: pd.DataFrame) -> pd.DataFrame:
+    def _counts_validations(counts: Union[pd.DataFrame, SparseCounts], meta: pd.DataFrame) -> Union[
+            pd.DataFrame, SparseCounts]:
         if not len(counts.columns):
             raise ParseCountsException('Counts values are not decimal values', 'Incorrect file format')
-        try:
-            counts = counts.astype(pd.np.float)  # type: pd.DataFrame
-        except:
-            raise ParseCountsException
+        if not isinstance(counts, SparseCounts):
+            try:
+                counts = counts.astype(float)  # type: pd.DataFrame
+            except:
+                raise ParseCountsException
         meta.index = meta.index.astype(str)
-        for cell in meta.index.values:
-            if cell not in counts.columns.values:
-                raise ParseCountsException('Some cells in meta didnt exist in counts columns',
-                                           'Maybe incorrect file format')
+        if not meta.index.isin(counts.columns).all():
+            raise ParseCountsException('Some cells in meta didnt exist in counts columns',
+                                       'Maybe incorrect file format')
         return counts
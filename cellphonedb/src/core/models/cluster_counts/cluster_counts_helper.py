@@ -1,6 +1,9 @@
 import itertools
+from typing import Union
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 from cellphonedb.src.core.core_logger import core_logger
 from cellphonedb.src.core.models.cluster_counts.cluster_counts_filter import filter_empty_cluster_counts
@@ -29,20 +32,59 @@ def merge_complex_counts(clusters_names: list, complex_counts_composition: pd.Da
     if complex_counts_composition.empty:
         return pd.DataFrame()
 
-    def set_complex_cluster_counts(row):
-        scores_complex = complex_counts_composition[
-            row['complex_multidata_id'] == complex_counts_composition['complex_multidata_id']]
-
-        for cluster_name in clusters_names:
-            row[cluster_name] = scores_complex[cluster_name].min()
-        return row
-
     complex_counts = complex_counts_composition.drop_duplicates(['complex_multidata_id'])
-    complex_counts = complex_counts.apply(set_complex_cluster_counts, axis=1)
-    complex_counts = complex_counts[clusters_names + complex_columns_names]
+    complex_counts = complex_counts[clusters_names + complex_columns_names].copy()
+    complex_counts[clusters_names] = get_groups_minimum(complex_counts_composition[clusters_names].values,
+                                                        complex_counts_composition['complex_multidata_id'].values)
+
     return complex_counts
 
 
+def get_groups_minimum(counts_matrix: Union[np.ndarray, sparse.spmatrix],
+                       groups: np.ndarray) -> Union[np.ndarray, sparse.spmatrix]:
+    """
+    Calculates the element-wise minimum of the counts_matrix rows of each group, in order of first appearance.
+    counts_matrix can be a dense or a scipy sparse matrix.
+
+    The rows are reduced by position in the group: the minimum of the first rows of each group is combined with the
+    second rows, and so on (groups without that position use their first row again), so the number of operations
+    only depends on the size of the biggest group.
+    ie:
+
+    counts_matrix:
+            cell1   cell2   cell3
+    row1    0.1     0.2     0.2
+    row2    0.2     0.1     0.5
+    row3    0.3     0.0     0.4
+
+    groups = [complex_1, complex_2, complex_1]
+
+    result:
+                cell1   cell2   cell3
+    complex_1   0.1     0.0     0.2
+    complex_2   0.2     0.1     0.5
+    """
+    groups_codes, _ = pd.factorize(groups, sort=False)
+    groups_positions = pd.Series(groups_codes).groupby(groups_codes).cumcount().values
+    _, groups_first_rows = np.unique(groups_codes, return_index=True)
+
+    if sparse.issparse(counts_matrix):
+        counts_matrix = counts_matrix.tocsr()
+
+    groups_minimum = counts_matrix[groups_first_rows]
+    for position in range(1, groups_positions.max() + 1):
+        position_rows = groups_first_rows.copy()
+        in_position = groups_positions == position
+        position_rows[groups_codes[in_position]] = np.flatnonzero(in_position)
+
+        if sparse.issparse(groups_minimum):
+            groups_minimum = groups_minimum.minimum(counts_matrix[position_rows])
+        else:
+            groups_minimum = np.fmin(groups_minimum, counts_matrix[position_rows])
+
+    return groups_minimum
+
+
 def get_cluster_combinations(cluster_names):
     return list(itertools.product(cluster_names, repeat=2))
 
@@ -13,18 +13,11 @@ def get_involved_complex_from_protein(proteins: pd.DataFrame, complexes: pd.Data
     if complex_counts_composition.empty:
         return pd.DataFrame()
 
-    def all_protein_involved(complex):
-        number_proteins_in_counts = len(
-            complex_counts_composition[
-                complex_counts_composition['complex_multidata_id'] == complex['complex_multidata_id']])
-
-        if number_proteins_in_counts < complex['total_protein']:
-            return False
-
-        return True
+    number_proteins_in_counts = complex_counts_composition.groupby('complex_multidata_id')[
+        'complex_multidata_id'].transform('size')
 
     complex_counts_composition = complex_counts_composition[
-        complex_counts_composition.apply(all_protein_involved, axis=1)]
+        number_proteins_in_counts >= complex_counts_composition['total_protein']]
 
     complex_counts_composition = pd.merge(complex_counts_composition, complexes,
                                           left_on='complex_multidata_id',
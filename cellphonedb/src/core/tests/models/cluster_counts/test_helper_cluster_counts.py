@@ -1,6 +1,8 @@
 from unittest import TestCase
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 from cellphonedb.src.core.Cellphonedb import data_test_dir
 from cellphonedb.src.core.models.cluster_counts import cluster_counts_helper
@@ -43,6 +45,23 @@ class TestHelperClusterCounts(TestCase):
 
         self.assertTrue(dataframe_functions.dataframes_has_same_data(result, expected_result))
 
+    def test_get_groups_minimum_sparse(self):
+        complex_counts_composition = pd.read_csv(
+            '{}/cluster_counts_helper_merge_complex_cluster_counts_complex_counts_composition.csv'.format(
+                self.FIXTURES_SUBPATH))
+        cluster_names = ['cluster_1', 'cluster_2', 'cluster_3']
+
+        counts_matrix = complex_counts_composition[cluster_names].values
+        groups = complex_counts_composition['complex_multidata_id'].values
+
+        result = cluster_counts_helper.get_groups_minimum(sparse.csr_matrix(counts_matrix), groups)
+        expected_result = complex_counts_composition.groupby('complex_multidata_id', sort=False)[cluster_names].min()
+
+        self.assertTrue(sparse.issparse(result))
+        self.assertTrue(np.allclose(result.toarray(), expected_result.values))
+        self.assertTrue(np.allclose(cluster_counts_helper.get_groups_minimum(counts_matrix, groups),
+                                    expected_result.values))
+
     def test_merge_complex_cluster_counts_empty(self):
         complex_counts_composition = pd.read_csv(
             '{}/cluster_counts_helper_merge_complex_cluster_counts_complex_counts_composition.csv'.format(
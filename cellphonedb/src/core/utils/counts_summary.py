@@ -0,0 +1,217 @@
+from typing import Iterable, Union
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from cellphonedb.src.core.utils.sparse_counts import SparseCounts
+from cellphonedb.src.exceptions.ParseCountsException import ParseCountsException
+
+
+class CountsSummary(object):
+    """
+    Per cell type summary of a counts table with everything the non statistical analysis needs: the number of cells of
+    each cell type and, for each gene and cell type, the sum of the counts and the number of cells with positive
+    counts. For the complexes, only the number of cells with all the component genes expressed is kept.
+
+    The summary is built streaming the counts in chunks of genes, so the whole counts table is never loaded, and it is
+    stored as a long table with one row per gene (or complex) and cell type:
+
+    name        type        cell_type   cells   sum     nonzero
+    ensembl1    gene        cell_type1  10      2.5     4
+    ensembl1    gene        cell_type2  20      0.0     0
+    complex1    complex     cell_type1  10              2
+    """
+    columns = ['name', 'type', 'cell_type', 'cells', 'sum', 'nonzero']
+
+    def __init__(self, cell_types: list, cells: np.ndarray, genes: list, sums: np.ndarray, nonzero: np.ndarray,
+                 complexes: list, complexes_nonzero: np.ndarray):
+        self.cell_types = list(cell_types)
+        self.cells = np.asarray(cells, dtype=np.int64)
+        self.genes = pd.Index(genes)
+        self.sums = np.asarray(sums, dtype=np.float64).reshape(len(self.genes), len(self.cell_types))
+        self.nonzero = np.asarray(nonzero, dtype=np.int64).reshape(len(self.genes), len(self.cell_types))
+        self.complexes = list(complexes)
+        self.complexes_nonzero = np.asarray(complexes_nonzero, dtype=np.int64).reshape(len(self.complexes),
+                                                                                       len(self.cell_types))
+
+    @classmethod
+    def from_counts_chunks(cls, meta: pd.DataFrame, counts_chunks: Iterable[Union[pd.DataFrame, SparseCounts]],
+                           complexes_components: pd.DataFrame) -> 'CountsSummary':
+        """
+        Builds the summary of the meta cells from genes x cells counts chunks, as DataFrames or SparseCounts.
+
+        complexes_components has one row for each complex ('complex'), component protein ('protein') and gene
+        ('gene'). Only the complexes with genes for all the components in counts are kept. Duplicated genes keep
+        their first counts, like the analysis prefilters.
+        """
+        cell_types = meta['cell_type'].drop_duplicates().tolist()
+        cells_clusters = pd.Categorical(meta['cell_type'], categories=cell_types).codes
+        indicator = sparse.csr_matrix((np.ones(len(meta)), (np.arange(len(meta)), cells_clusters)),
+                                      shape=(len(meta), len(cell_types)))
+
+        complexes = complexes_components['complex'].drop_duplicates().tolist()
+        complexes_positions = pd.Series(np.arange(len(complexes)), index=complexes)
+
+        genes_complexes = {}
+        for gene, complex_position in zip(complexes_components['gene'],
+                                          complexes_positions.reindex(complexes_components['complex']).values):
+            genes_complexes.setdefault(gene, set()).add(complex_position)
+        genes_complexes = {gene: sorted(gene_complexes) for gene, gene_complexes in genes_complexes.items()}
+
+        complexes_expressed = np.ones((len(complexes), len(meta)), dtype=bool)
+
+        genes = []
+        genes_found = set()
+        sums = []
+        nonzero = []
+        for chunk in counts_chunks:
+            chunk_genes, counts_matrix = cls._get_chunk_counts(chunk, meta)
+
+            new_genes = np.array([gene not in genes_found for gene in chunk_genes], dtype=bool)
+            new_genes &= ~chunk_genes.duplicated()
+            chunk_genes = chunk_genes[new_genes]
+            counts_matrix = counts_matrix[np.flatnonzero(new_genes)]
+            expressed = counts_matrix > 0
+
+            genes.extend(chunk_genes)
+            genes_found.update(chunk_genes)
+            sums.append(_clusters_sums(counts_matrix, indicator))
+            nonzero.append(_clusters_sums(expressed.astype(np.float64), indicator))
+
+            for row, gene in enumerate(chunk_genes):
+                if gene in genes_complexes:
+                    gene_expressed = expressed[row].toarray().ravel() if sparse.issparse(expressed) else expressed[row]
+                    complexes_expressed[genes_complexes[gene]] &= gene_expressed
+
+        components_found = complexes_components[complexes_components['gene'].isin(genes)]
+        proteins_number = complexes_components.groupby('complex')['protein'].nunique()
+        proteins_found = components_found.groupby('complex')['protein'].nunique()
+        complexes_found = [complex_name for complex_name in complexes
+                           if proteins_found.get(complex_name, 0) == proteins_number[complex_name]]
+
+        complexes_found_positions = complexes_positions.reindex(complexes_found).values.astype(np.int64)
+        complexes_nonzero = _clusters_sums(complexes_expressed[complexes_found_positions].astype(np.float64),
+                                           indicator)
+
+        return cls(cell_types,
+                   np.bincount(cells_clusters, minlength=len(cell_types)),
+                   genes,
+                   np.concatenate(sums) if sums else np.empty((0, len(cell_types))),
+                   np.rint(np.concatenate(nonzero)) if nonzero else np.empty((0, len(cell_types))),
+                   complexes_found,
+                   np.rint(complexes_nonzero))
+
+    @classmethod
+    def from_dataframe(cls, summary: pd.DataFrame) -> 'CountsSummary':
+        """
+        Reads the summary from its long table
+        """
+        missing_columns = [column for column in cls.columns if column not in summary.columns]
+        if missing_columns:
+            raise ParseCountsException('Summary columns missing: {}'.format(', '.join(missing_columns)),
+                                       'Build the summary with cellphonedb method summarize')
+
+        cell_types = summary['cell_type'].drop_duplicates().tolist()
+        cells = summary.drop_duplicates('cell_type').set_index('cell_type')['cells'].reindex(cell_types).values
+
+        genes_summary = summary[summary['type'] == 'gene']
+        complexes_summary = summary[summary['type'] == 'complex']
+
+        genes = genes_summary['name'].drop_duplicates().tolist()
+        complexes = complexes_summary['name'].drop_duplicates().tolist()
+
+        def summary_table(table_summary: pd.DataFrame, names: list, values: str) -> np.ndarray:
+            return table_summary.pivot(index='name', columns='cell_type', values=values).reindex(
+                index=names, columns=cell_types).fillna(0).values
+
+        return cls(cell_types,
+                   cells,
+                   genes,
+                   summary_table(genes_summary, genes, 'sum'),
+                   summary_table(genes_summary, genes, 'nonzero'),
+                   complexes,
+                   summary_table(complexes_summary, complexes, 'nonzero'))
+
+    def to_dataframe(self) -> pd.DataFrame:
+        genes_summary = self._long_table(self.genes, 'gene', self.sums, self.nonzero)
+        complexes_summary = self._long_table(self.complexes, 'complex',
+                                             np.full(self.complexes_nonzero.shape, np.nan), self.complexes_nonzero)
+
+        return genes_summary.append(complexes_summary, ignore_index=True, sort=False)
+
+    def to_counts(self) -> pd.DataFrame:
+        """
+        Returns the genes x cell types sums as a counts table. The analysis prefilters and the complexes representative
+        genes only compare the genes totals, which are kept by the sums.
+        """
+        return pd.DataFrame(self.sums, index=self.genes, columns=self.cell_types)
+
+    def expressed_complexes(self) -> list:
+        """
+        Returns the complexes with cells expressing all the components
+        """
+        return [complex_name for complex_name, nonzero in zip(self.complexes, self.complexes_nonzero.sum(axis=1))
+                if nonzero > 0]
+
+    def build_clusters(self, genes: pd.Index) -> dict:
+        """
+        Builds the cluster structure of cpdb_statistical_analysis_helper.build_clusters for the given genes from the
+        summary: the means are the sums divided by the cell type cells and the percents the fraction of nonzero cells.
+        """
+        genes_positions = self.genes.get_indexer(genes)
+
+        means_table = self.sums[genes_positions] / self.cells
+        percents_table = self.nonzero[genes_positions] / self.cells
+
+        cluster_means = {cluster_name: pd.Series(means_table[:, cluster_position], index=genes)
+                         for cluster_position, cluster_name in enumerate(self.cell_types)}
+
+        return {'names': self.cell_types,
+                'genes': genes,
+                'means_table': means_table,
+                'percents_table': percents_table,
+                'means': cluster_means}
+
+    def _long_table(self, names: list, names_type: str, sums: np.ndarray, nonzero: np.ndarray) -> pd.DataFrame:
+        cell_types_number = len(self.cell_types)
+
+        return pd.DataFrame({'name': np.repeat(np.array(names, dtype=object), cell_types_number),
+                             'type': names_type,
+                             'cell_type': np.tile(np.array(self.cell_types, dtype=object), len(names)),
+                             'cells': np.tile(self.cells, len(names)),
+                             'sum': sums.ravel(),
+                             'nonzero': nonzero.ravel()},
+                            columns=self.columns)
+
+    @staticmethod
+    def _get_chunk_counts(chunk: Union[pd.DataFrame, SparseCounts], meta: pd.DataFrame) -> (pd.Index, Union[
+            np.ndarray, sparse.spmatrix]):
+        """
+        Returns the chunk genes and the counts of the meta cells, in meta order
+        """
+        if not meta.index.isin(chunk.columns.astype(str)).all():
+            raise ParseCountsException('Some cells in meta didnt exist in counts columns',
+                                       'Maybe incorrect file format')
+
+        if isinstance(chunk, SparseCounts):
+            chunk = chunk.filter_cells(meta.index)
+            return chunk.index, chunk.matrix
+
+        chunk.columns = chunk.columns.astype(str)
+        try:
+            counts_matrix = chunk.loc[:, meta.index].values.astype(np.float64)
+        except ValueError:
+            raise ParseCountsException
+
+        return pd.Index(chunk.index).astype(str), counts_matrix
+
+
+def _clusters_sums(counts_matrix: Union[np.ndarray, sparse.spmatrix], indicator: sparse.spmatrix) -> np.ndarray:
+    """
+    Sums the genes x cells counts of each cluster, with a cells x clusters indicator matrix
+    """
+    clusters_sums = indicator.T.dot(counts_matrix.T)
+    clusters_sums = clusters_sums.toarray() if sparse.issparse(clusters_sums) else np.asarray(clusters_sums)
+
+    return clusters_sums.T
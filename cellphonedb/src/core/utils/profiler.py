@@ -0,0 +1,75 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Profiler(object):
+    """
+    Records the wall time, CPU time and peak memory of the method stages and the dimensions of the inputs.
+
+    The CPU time of a stage includes the worker processes finished during it. The peak memory is the maximum resident
+    set size reached by the process (and by its finished workers) until the end of the stage. Stages can be nested:
+    the inner stages are named after the outer ones (ie: 'simple_analysis/prefilters').
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.dimensions = {}
+        self._running_stages = []
+
+    @contextmanager
+    def stage(self, name: str):
+        self._running_stages.append(name)
+        stage = {'stage': '/'.join(self._running_stages)}
+        self.stages.append(stage)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        children_cpu_start = self._children_cpu_time()
+
+        try:
+            yield
+        finally:
+            self._running_stages.pop()
+            stage.update({
+                'wall_seconds': round(time.perf_counter() - wall_start, 3),
+                'cpu_seconds': round(time.process_time() - cpu_start, 3),
+                'children_cpu_seconds': round(self._children_cpu_time() - children_cpu_start, 3),
+                'peak_rss_mb': self._peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+                'children_peak_rss_mb': self._peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+            })
+
+    def set_dimensions(self, **dimensions) -> None:
+        self.dimensions.update({name: int(value) for name, value in dimensions.items()})
+
+    def report(self) -> dict:
+        return {'dimensions': self.dimensions,
+                'stages': self.stages}
+
+    def write(self, filename: str) -> None:
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    @staticmethod
+    def _children_cpu_time() -> float:
+        if resource is None:
+            return 0.0
+
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    @staticmethod
+    def _peak_rss_mb(who: int) -> float:
+        """
+        ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        """
+        max_rss = resource.getrusage(who).ru_maxrss
+        max_rss_bytes = max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+        return round(max_rss_bytes / (1024 * 1024), 1)
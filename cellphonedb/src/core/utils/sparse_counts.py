@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from cellphonedb.src.exceptions.ParseCountsException import ParseCountsException
+
+
+class SparseCounts(object):
+    """
+    Genes x cells counts stored as a scipy sparse matrix, labelled with the genes and cells like a counts DataFrame.
+
+    It is used to read big sparse inputs without building the dense table: the genes and cells are filtered on the
+    sparse matrix and only the remaining genes are converted to a DataFrame.
+    """
+
+    def __init__(self, matrix: sparse.spmatrix, genes: list, cells: list):
+        self.matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+        self.index = pd.Index(genes).astype(str)
+        self.columns = pd.Index(cells).astype(str)
+
+        if self.matrix.shape != (len(self.index), len(self.columns)):
+            raise ParseCountsException('Counts matrix shape {} doesnt match {} genes and {} cells'.format(
+                self.matrix.shape, len(self.index), len(self.columns)), 'Check the genes and cells files')
+
+    @property
+    def shape(self) -> tuple:
+        return self.matrix.shape
+
+    def filter_genes(self, genes: list) -> 'SparseCounts':
+        """
+        Keeps only the counts of the given genes
+        """
+        genes_indexes = np.flatnonzero(self.index.isin(genes))
+
+        return SparseCounts(self.matrix[genes_indexes], self.index[genes_indexes], self.columns)
+
+    def filter_cells(self, cells: list) -> 'SparseCounts':
+        """
+        Keeps only the counts of the given cells, in the given order
+        """
+        cells_indexes = self.columns.get_indexer(cells)
+
+        return SparseCounts(self.matrix.tocsc()[:, cells_indexes], self.index, self.columns[cells_indexes])
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.matrix.toarray(), index=self.index, columns=self.columns)
@@ -1,9 +1,12 @@
+from typing import Union
+
 import numpy as np
 import pandas as pd
 from fbpca import pca
 from geosketch import gs
 
 from cellphonedb.src.core.core_logger import core_logger
+from cellphonedb.src.core.utils.sparse_counts import SparseCounts
 
 
 class Subsampler(object):
@@ -14,7 +17,7 @@ class Subsampler(object):
         self.num_cells = num_cells
         np.random.seed(debug_seed)
 
-    def subsample(self, counts: pd.DataFrame) -> pd.DataFrame:
+    def subsample(self, counts: Union[pd.DataFrame, SparseCounts]) -> Union[pd.DataFrame, SparseCounts]:
         input_genes = counts.shape[1]
 
         if self.num_cells is None:
@@ -22,18 +25,17 @@ class Subsampler(object):
 
         core_logger.info('Subsampling {} to {}'.format(input_genes, self.num_cells))
 
-        counts_t = counts.T
-
-        if self.log:
-            pca_input = np.log1p(counts_t)
+        if isinstance(counts, SparseCounts):
+            counts_t = counts.matrix.T.tocsr()
+            pca_input = counts_t.log1p() if self.log else counts_t
         else:
-            pca_input = counts_t
+            counts_t = counts.T
+            pca_input = np.log1p(counts_t).values if self.log else counts_t.values
 
         try:
-            u, s, vt = pca(pca_input.values, k=self.num_pc)
+            u, s, vt = pca(pca_input, k=self.num_pc)
             x_dimred = u[:, :self.num_pc] * s[:self.num_pc]
             sketch_index = gs(x_dimred, self.num_cells, replace=False)
-            x_matrix = counts_t.iloc[sketch_index]
         except Exception as e:
             core_logger.warning('Subsampling failed: ignored.')
             if self.verbose:
@@ -42,4 +44,7 @@ class Subsampler(object):
 
         core_logger.info('Done subsampling {} to {}'.format(input_genes, self.num_cells))
 
-        return x_matrix.T
+        if isinstance(counts, SparseCounts):
+            return counts.filter_cells(counts.columns[sketch_index])
+
+        return counts_t.iloc[sketch_index].T
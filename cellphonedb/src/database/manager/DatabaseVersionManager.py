@@ -48,6 +48,8 @@ def _ensure_core_version_in_user_dbs():
     copy_file(os.path.join(core_dir, database_file), dest_folder)
     copy_tree(os.path.join(core_dir, 'data'), dest_folder)
 
+    build_database_cache(database_file_location)
+
 
 def find_database_for(value: str) -> str:
     file_candidate = os.path.expanduser(value)
@@ -134,11 +136,28 @@ def download_database(version):
                     with open(dest_file, 'wb') as fw:
                         fw.write(zf.read())
 
+        database_file_location = os.path.join(output_folder, database_file)
+        if os.path.isfile(database_file_location):
+            build_database_cache(database_file_location)
+
     except NoReleasesException:
         print('There are no versions available (or connection could not be made to server to retrieve them)')
         exit(1)
 
 
+def build_database_cache(database_file_location: str) -> None:
+    """
+    Compiles the expanded tables used by the methods into the database cache, next to the database file
+    """
+    database_manager = create_app(database_file=database_file_location).database_manager
+
+    database_manager.get_repository('interaction').get_all()
+    database_manager.get_repository('interaction').get_all_expanded()
+    database_manager.get_repository('gene').get_all_expanded()
+    database_manager.get_repository('complex').get_all_expanded()
+    database_manager.get_repository('complex').get_all_compositions()
+
+
 def list_local_versions() -> list:
     try:
         releases_folder = os.path.expanduser(cpdb_releases)
@@ -1,11 +1,15 @@
 import os
-from typing import Optional
+from typing import Optional, Union
 
 import pandas as pd
 
 from cellphonedb.src.app.app_logger import app_logger
 from cellphonedb.src.app.cellphonedb_app import output_dir
+from cellphonedb.src.core.utils.counts_summary import CountsSummary
+from cellphonedb.src.core.utils.profiler import Profiler
+from cellphonedb.src.core.utils.sparse_counts import SparseCounts
 from cellphonedb.src.core.utils.subsampler import Subsampler
+from cellphonedb.src.exceptions.ReadFileException import ReadFileException
 from cellphonedb.utils import utils
 from cellphonedb.utils.utils import write_to_file
 
@@ -39,6 +43,17 @@ class LocalMethodLauncher(object):
                                                         result_precision: int = 3,
                                                         pvalue: float = 0.05,
                                                         subsampler: Subsampler = None,
+                                                        output_compression: Optional[str] = None,
+                                                        max_exceedances: int = 0,
+                                                        cell_types_filename: Optional[str] = None,
+                                                        cluster_pairs_filename: Optional[str] = None,
+                                                        interactions_filename: Optional[str] = None,
+                                                        interaction_classes: Optional[list] = None,
+                                                        checkpoint_dir: Optional[str] = None,
+                                                        checkpoint_iterations: int = 1000,
+                                                        resume: bool = False,
+                                                        profile: bool = False,
+                                                        pvalue_method: str = 'permutation',
                                                         ) -> None:
         output_path = self._set_paths(output_path, project_name)
 
@@ -47,8 +62,16 @@ class LocalMethodLauncher(object):
         threads = int(threads)
         threshold = float(threshold)
         result_precision = int(result_precision)
+        max_exceedances = int(max_exceedances)
+        checkpoint_iterations = int(checkpoint_iterations)
 
-        counts, meta = self._load_meta_counts(counts_filename, meta_filename)
+        interactions_filter = self._get_interactions_filter(interactions_filename, interaction_classes)
+
+        profiler = Profiler()
+        with profiler.stage('loading'):
+            counts, meta = self._load_meta_counts(counts_filename, meta_filename, counts_data,
+                                                  self._get_counts_genes_filter(counts_data, subsampler,
+                                                                                interactions_filter))
 
         pvalues_simple, means_simple, significant_means_simple, deconvoluted_simple = \
             self.cellphonedb_app.method.cpdb_statistical_analysis_launcher(
@@ -61,13 +84,27 @@ class LocalMethodLauncher(object):
                 debug_seed,
                 result_precision,
                 pvalue,
-                subsampler
+                subsampler,
+                max_exceedances,
+                self._read_list(cell_types_filename),
+                self._read_list(cluster_pairs_filename),
+                interactions_filter,
+                checkpoint_dir,
+                checkpoint_iterations,
+                resume,
+                profiler,
+                pvalue_method
             )
 
-        write_to_file(means_simple, means_filename, output_path, output_format)
-        write_to_file(pvalues_simple, pvalues_filename, output_path, output_format)
-        write_to_file(significant_means_simple, significant_means_filename, output_path, output_format)
-        write_to_file(deconvoluted_simple, deconvoluted_filename, output_path, output_format)
+        with profiler.stage('writing'):
+            write_to_file(means_simple, means_filename, output_path, output_format, output_compression)
+            write_to_file(pvalues_simple, pvalues_filename, output_path, output_format, output_compression)
+            write_to_file(significant_means_simple, significant_means_filename, output_path, output_format,
+                          output_compression)
+            write_to_file(deconvoluted_simple, deconvoluted_filename, output_path, output_format, output_compression)
+
+        if profile:
+            self._write_profile(profiler, output_path)
 
     def cpdb_analysis_local_method_launcher(self, meta_filename: str,
                                             counts_filename: str,
@@ -81,13 +118,25 @@ class LocalMethodLauncher(object):
                                             deconvoluted_filename='deconvoluted',
                                             result_precision: int = 3,
                                             subsampler: Subsampler = None,
+                                            output_compression: Optional[str] = None,
+                                            cell_types_filename: Optional[str] = None,
+                                            cluster_pairs_filename: Optional[str] = None,
+                                            interactions_filename: Optional[str] = None,
+                                            interaction_classes: Optional[list] = None,
+                                            profile: bool = False,
                                             ) -> None:
         output_path = self._set_paths(output_path, project_name)
 
         result_precision = int(result_precision)
         threshold = float(threshold)
 
-        counts, meta = self._load_meta_counts(counts_filename, meta_filename)
+        interactions_filter = self._get_interactions_filter(interactions_filename, interaction_classes)
+
+        profiler = Profiler()
+        with profiler.stage('loading'):
+            counts, meta = self._load_meta_counts(counts_filename, meta_filename, counts_data,
+                                                  self._get_counts_genes_filter(counts_data, subsampler,
+                                                                                interactions_filter))
 
         means, significant_means, deconvoluted = \
             self.cellphonedb_app.method.cpdb_method_analysis_launcher(meta,
@@ -95,11 +144,107 @@ class LocalMethodLauncher(object):
                                                                       counts_data,
                                                                       threshold,
                                                                       result_precision,
-                                                                      subsampler)
+                                                                      subsampler,
+                                                                      self._read_list(cell_types_filename),
+                                                                      self._read_list(cluster_pairs_filename),
+                                                                      interactions_filter,
+                                                                      profiler)
+
+        with profiler.stage('writing'):
+            write_to_file(means, means_filename, output_path, output_format, output_compression)
+            write_to_file(significant_means, significant_means_filename, output_path, output_format,
+                          output_compression)
+            write_to_file(deconvoluted, deconvoluted_filename, output_path, output_format, output_compression)
+
+        if profile:
+            self._write_profile(profiler, output_path)
+
+    def summarize_local_method_launcher(self, meta_filename: str,
+                                        counts_filename: str,
+                                        counts_data: str,
+                                        project_name: str = '',
+                                        output_path: str = '',
+                                        output_format: Optional[str] = None,
+                                        summary_filename: str = 'summary',
+                                        chunksize: int = 1000,
+                                        ) -> None:
+        output_path = self._set_paths(output_path, project_name)
+
+        meta = utils.read_data_table_from_file(os.path.realpath(meta_filename))
+        counts_chunks = utils.read_counts_chunks_from_file(os.path.realpath(counts_filename), counts_data,
+                                                           int(chunksize))
+
+        summary = self.cellphonedb_app.method.cpdb_summarize_launcher(meta, counts_chunks, counts_data)
+
+        write_to_file(summary.to_dataframe(), summary_filename, output_path, output_format)
+
+    def cpdb_analysis_summary_local_method_launcher(self, summary_filename: str,
+                                                    counts_data: str,
+                                                    project_name: str = '',
+                                                    threshold: float = 0.1,
+                                                    output_path: str = '',
+                                                    output_format: Optional[str] = None,
+                                                    means_filename: str = 'means',
+                                                    significant_means_filename: str = 'significant_means',
+                                                    deconvoluted_filename='deconvoluted',
+                                                    result_precision: int = 3,
+                                                    output_compression: Optional[str] = None,
+                                                    cell_types_filename: Optional[str] = None,
+                                                    cluster_pairs_filename: Optional[str] = None,
+                                                    interactions_filename: Optional[str] = None,
+                                                    interaction_classes: Optional[list] = None,
+                                                    profile: bool = False,
+                                                    ) -> None:
+        output_path = self._set_paths(output_path, project_name)
+
+        result_precision = int(result_precision)
+        threshold = float(threshold)
+
+        interactions_filter = self._get_interactions_filter(interactions_filename, interaction_classes)
+
+        profiler = Profiler()
+        with profiler.stage('loading'):
+            summary = CountsSummary.from_dataframe(
+                utils.read_data_table_from_file(os.path.realpath(summary_filename), dtype={'name': str}))
+
+        means, significant_means, deconvoluted = \
+            self.cellphonedb_app.method.cpdb_method_analysis_summary_launcher(summary,
+                                                                              counts_data,
+                                                                              threshold,
+                                                                              result_precision,
+                                                                              self._read_list(cell_types_filename),
+                                                                              self._read_list(cluster_pairs_filename),
+                                                                              interactions_filter,
+                                                                              profiler)
 
-        write_to_file(means, means_filename, output_path, output_format)
-        write_to_file(significant_means, significant_means_filename, output_path, output_format)
-        write_to_file(deconvoluted, deconvoluted_filename, output_path, output_format)
+        with profiler.stage('writing'):
+            write_to_file(means, means_filename, output_path, output_format, output_compression)
+            write_to_file(significant_means, significant_means_filename, output_path, output_format,
+                          output_compression)
+            write_to_file(deconvoluted, deconvoluted_filename, output_path, output_format, output_compression)
+
+        if profile:
+            self._write_profile(profiler, output_path)
+
+    @staticmethod
+    def _read_list(filename: Optional[str]) -> Optional[list]:
+        """
+        Reads a list of values from a file with one value per line, ignoring empty lines
+        """
+        if filename is None:
+            return None
+
+        try:
+            with open(filename) as f:
+                return [line.strip() for line in f if line.strip()]
+        except OSError:
+            raise ReadFileException(filename)
+
+    @staticmethod
+    def _write_profile(profiler: Profiler, output_path: str) -> None:
+        profile_filename = os.path.join(output_path, 'profile.json')
+        profiler.write(profile_filename)
+        app_logger.info('Profile report written to {}'.format(profile_filename))
 
     @staticmethod
     def _path_is_empty(path):
@@ -117,12 +262,45 @@ class LocalMethodLauncher(object):
                 'Output directory ({}) exist and is not empty. Result can overwrite old results'.format(output_path))
         return output_path
 
+    def _get_interactions_filter(self, interactions_filename: Optional[str],
+                                 interaction_classes: Optional[list]) -> Optional[dict]:
+        """
+        Builds the interactions selection from a file of interaction ids, partner names or genes and a list of
+        interaction classes. Returns None if nothing is selected
+        """
+        interactions_filter = {'names': self._read_list(interactions_filename),
+                               'classes': list(interaction_classes) if interaction_classes else None}
+
+        if not any(interactions_filter.values()):
+            return None
+
+        return interactions_filter
+
+    def _get_counts_genes_filter(self, counts_data: str, subsampler: Optional[Subsampler],
+                                 interactions_filter: Optional[dict] = None) -> Optional[list]:
+        """
+        Returns the genes used by the database interactions, the only counts needed by the methods.
+        Subsampling needs all the genes, so nothing is filtered when it is enabled.
+        """
+        if subsampler is not None:
+            return None
+
+        return self.cellphonedb_app.method.get_interacting_genes(counts_data, interactions_filter)
+
     @staticmethod
-    def _load_meta_counts(counts_filename: str, meta_filename: str) -> (pd.DataFrame, pd.DataFrame):
+    def _load_meta_counts(counts_filename: str, meta_filename: str, counts_data: str = 'ensembl',
+                          genes: Optional[list] = None) -> (Union[pd.DataFrame, SparseCounts], pd.DataFrame):
         """
+        Loads meta and counts. If genes is set, the counts table is read in chunks keeping only those genes.
+
         :raise ParseMetaException
         """
         meta = utils.read_data_table_from_file(os.path.realpath(meta_filename))
-        counts = utils.read_data_table_from_file(os.path.realpath(counts_filename), index_column_first=True)
+
+        if utils.is_sparse_counts_file(counts_filename):
+            counts = utils.read_sparse_counts_from_file(os.path.realpath(counts_filename), counts_data)
+        else:
+            counts = utils.read_data_table_from_file(os.path.realpath(counts_filename), index_column_first=True,
+                                                     index_filter=genes)
 
         return counts, meta
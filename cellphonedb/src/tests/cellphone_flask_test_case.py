@@ -3,7 +3,9 @@ import random
 import string
 import time
 
+import pandas as pd
 from flask_testing import TestCase
+from scipy import io, sparse
 
 from cellphonedb.src.app.cellphonedb_app import cellphonedb_app
 from cellphonedb.src.local_launchers.local_collector_launcher import LocalCollectorLauncher
@@ -31,6 +33,27 @@ class CellphoneFlaskTestCase(TestCase):
     def remove_file(file):
         os.remove(file)
 
+    @staticmethod
+    def write_sparse_counts(counts_filename: str, counts_format: str, output_dir: str) -> str:
+        """
+        Writes the counts table as a sparse matrix with the 10x barcodes and features files in output_dir
+        """
+        counts = utils.read_data_table_from_file(counts_filename, index_column_first=True)
+        matrix = sparse.csr_matrix(counts.values)
+
+        sparse_counts_filename = os.path.join(output_dir, 'matrix.{}'.format(counts_format))
+        if counts_format == 'npz':
+            sparse.save_npz(sparse_counts_filename, matrix)
+        else:
+            io.mmwrite(sparse_counts_filename, matrix)
+
+        pd.DataFrame(counts.columns).to_csv(os.path.join(output_dir, 'barcodes.tsv'), sep='\t', header=False,
+                                            index=False)
+        pd.DataFrame(counts.index).to_csv(os.path.join(output_dir, 'features.tsv'), sep='\t', header=False,
+                                          index=False)
+
+        return sparse_counts_filename
+
     @staticmethod
     def rand_string(digits=5):
         return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(digits))
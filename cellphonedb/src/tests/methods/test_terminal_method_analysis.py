@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 from typing import Optional
 
 import pandas as pd
@@ -43,6 +45,21 @@ class TestTerminalMethodlAnalysis(CellphoneFlaskTestCase):
         result_precision = 3
         self._method_call(data, project_name, threshold, result_precision)
 
+    def test_non_statistical_method__data_test__threshold__01__precision_1_npz(self):
+        data = 'test'
+        project_name = 'test_data'
+        threshold = 0.1
+        result_precision = 1
+        self._method_call(data, project_name, threshold, result_precision, counts_format='npz')
+
+    def test_non_statistical_method__data_test__threshold__01__precision_1_gene_name_mtx(self):
+        data = 'test_custom_counts_data'
+        project_name = 'test_data'
+        threshold = 0.1
+        result_precision = 1
+        self._method_call(data, project_name, threshold, result_precision, counts_data='gene_name',
+                          counts_format='mtx')
+
     def test_non_statistical_method_subsampled_data_test__threshold__01__precision_3__num_pc_4__num_cells_4(self):
         data = 'test_subsampled'
         project_name = 'test_data'
@@ -51,8 +68,70 @@ class TestTerminalMethodlAnalysis(CellphoneFlaskTestCase):
         subsampler = Subsampler(False, 4, 4, debug_seed=0)
         self._method_call(data, project_name, threshold, result_precision, subsampler)
 
+    def test_non_statistical_method_from_summary__data_test__threshold__01__precision_3(self):
+        data = 'test'
+        project_name = 'test_data'
+        threshold = 0.1
+        result_precision = 3
+        self._summary_method_call(data, project_name, threshold, result_precision)
+
+    def test_non_statistical_method_from_summary__data_test__threshold__01__precision_1_gene_name_mtx(self):
+        data = 'test_custom_counts_data'
+        project_name = 'test_data'
+        threshold = 0.1
+        result_precision = 1
+        self._summary_method_call(data, project_name, threshold, result_precision, counts_data='gene_name',
+                                  counts_format='mtx')
+
+    def _summary_method_call(self, data: str, project_name: str, threshold: float, result_precision: int,
+                             counts_data: str = 'ensembl', counts_format: str = 'txt'):
+        result_means_filename = self._get_result_filename('means', data, threshold, result_precision)
+        result_significant_means_filename = self._get_result_filename('significant_means', data, threshold,
+                                                                      result_precision)
+        result_deconvoluted_filename = self._get_result_filename('deconvoluted', data, threshold, result_precision)
+        summary_filename = self._get_result_filename('summary', data, threshold, result_precision)
+
+        meta_filename = os.path.realpath('{}/hi_{}_meta.txt'.format(data_test_dir, data))
+
+        if counts_data == 'ensembl':
+            counts_file = '{}/hi_{}_counts.txt'.format(data_test_dir, data)
+        else:
+            counts_file = '{}/hi_{}_counts_{}.txt'.format(data_test_dir, data, counts_data)
+
+        counts_filename = os.path.realpath(counts_file)
+
+        if counts_format != 'txt':
+            sparse_counts_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, sparse_counts_dir)
+            counts_filename = self.write_sparse_counts(counts_filename, counts_format, sparse_counts_dir)
+
+        launcher = LocalMethodLauncher(cellphonedb_app.cellphonedb)
+        launcher.summarize_local_method_launcher(meta_filename, counts_filename, counts_data, project_name,
+                                                 output_test_dir, 'txt', summary_filename, chunksize=7)
+
+        summary_path = '{}/{}/{}'.format(output_test_dir, project_name, summary_filename)
+        self.addCleanup(self.remove_file, summary_path)
+
+        launcher.cpdb_analysis_summary_local_method_launcher(summary_path,
+                                                             counts_data,
+                                                             project_name,
+                                                             threshold,
+                                                             output_test_dir,
+                                                             'txt',
+                                                             result_means_filename,
+                                                             result_significant_means_filename,
+                                                             result_deconvoluted_filename,
+                                                             result_precision)
+
+        self._assert_result('means', data, project_name, result_means_filename, threshold, result_precision)
+        self._assert_result('significant_means', data, project_name, result_significant_means_filename, threshold,
+                            result_precision)
+        self._assert_result('deconvoluted', data, project_name, result_deconvoluted_filename, threshold,
+                            result_precision)
+
     def _method_call(self, data: str, project_name: str, threshold: float, result_precision: int,
-                     subsampler: Optional[Subsampler] = None, counts_data: str = 'ensembl'):
+                     subsampler: Optional[Subsampler] = None, counts_data: str = 'ensembl',
+                     counts_format: str = 'txt'):
         result_names_as_fixture = False
         if result_names_as_fixture:
             result_deconvoluted_filename, result_means_filename, result_significant_means_filename = self._original_names(
@@ -72,6 +151,11 @@ class TestTerminalMethodlAnalysis(CellphoneFlaskTestCase):
 
         counts_filename = os.path.realpath(counts_file)
 
+        if counts_format != 'txt':
+            sparse_counts_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, sparse_counts_dir)
+            counts_filename = self.write_sparse_counts(counts_filename, counts_format, sparse_counts_dir)
+
         LocalMethodLauncher(cellphonedb_app.cellphonedb).cpdb_analysis_local_method_launcher(meta_filename,
                                                                                              counts_filename,
                                                                                              counts_data,
@@ -1,14 +1,21 @@
+import json
 import os
+import shutil
+import tempfile
 from typing import Optional
+from unittest import mock
 
+import numpy as np
 import pandas as pd
 
 from cellphonedb.src.app.cellphonedb_app import output_test_dir, data_test_dir, cellphonedb_app
 from cellphonedb.src.app.flask.flask_app import create_app
+from cellphonedb.src.core.methods import cpdb_statistical_analysis_helper, cpdb_analysis_complex_method, \
+    cpdb_statistical_analysis_complex_method
 from cellphonedb.src.core.utils.subsampler import Subsampler
 from cellphonedb.src.local_launchers.local_method_launcher import LocalMethodLauncher
 from cellphonedb.src.tests.cellphone_flask_test_case import CellphoneFlaskTestCase
-from cellphonedb.utils import dataframe_functions
+from cellphonedb.utils import dataframe_functions, utils
 
 
 class TestTerminalMethodStatisticalAnalysis(CellphoneFlaskTestCase):
@@ -53,6 +60,16 @@ class TestTerminalMethodStatisticalAnalysis(CellphoneFlaskTestCase):
         result_precision = 3
         self._method_call(data, iterations, project_name, threshold, debug_seed, result_precision)
 
+    def test_statistical_method__data_test__it_10__seed_0__threshold__01__precision_1_mtx(self):
+        iterations = 10
+        data = 'test'
+        debug_seed = 0
+        project_name = 'test_data'
+        threshold = 0.1
+        result_precision = 1
+        self._method_call(data, iterations, project_name, threshold, debug_seed, result_precision,
+                          counts_format='mtx')
+
     def test_statistical_method_subsampled_data_test__threshold__01__precision_3__num_pc_4__num_cells_4(self):
         iterations = 10
         data = 'test_subsampled'
@@ -63,6 +80,240 @@ class TestTerminalMethodStatisticalAnalysis(CellphoneFlaskTestCase):
         subsampler = Subsampler(False, 4, 4, debug_seed=0)
         self._method_call(data, iterations, project_name, threshold, debug_seed, result_precision, subsampler)
 
+    def test_statistical_method__same_result_with_any_threads_number(self):
+        meta = utils.read_data_table_from_file('{}/hi_test_meta.txt'.format(data_test_dir))
+        counts = utils.read_data_table_from_file('{}/hi_test_counts.txt'.format(data_test_dir),
+                                                 index_column_first=True)
+
+        results = [cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(meta, counts, 'ensembl', 10,
+                                                                                         0.1, threads, 0, 3, 0.05)
+                   for threads in (1, 3)]
+
+        for single_thread_result, multi_thread_result in zip(*results):
+            self.assertTrue(dataframe_functions.dataframes_has_same_data(single_thread_result, multi_thread_result))
+
+    def test_statistical_method__max_exceedances_keeps_significant_means(self):
+        meta = utils.read_data_table_from_file('{}/hi_test_meta.txt'.format(data_test_dir))
+        counts = utils.read_data_table_from_file('{}/hi_test_counts.txt'.format(data_test_dir),
+                                                 index_column_first=True)
+
+        iterations = 100
+        pvalue = 0.05
+        max_exceedances = 6
+
+        exact_pvalues, _, exact_significant_means, _ = \
+            cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(meta, counts, 'ensembl', iterations,
+                                                                                  0.1, 2, 0, 3, pvalue)
+        sequential_pvalues, _, sequential_significant_means, _ = \
+            cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(meta, counts, 'ensembl', iterations,
+                                                                                  0.1, 2, 0, 3, pvalue,
+                                                                                  max_exceedances=max_exceedances)
+
+        self.assertTrue(dataframe_functions.dataframes_has_same_data(exact_significant_means,
+                                                                     sequential_significant_means))
+        self.assertFalse(dataframe_functions.dataframes_has_same_data(exact_pvalues, sequential_pvalues))
+
+    def test_statistical_method__cluster_pairs_same_values_as_all_pairs(self):
+        meta = utils.read_data_table_from_file('{}/hi_test_meta.txt'.format(data_test_dir))
+        counts = utils.read_data_table_from_file('{}/hi_test_counts.txt'.format(data_test_dir),
+                                                 index_column_first=True)
+
+        cluster_pairs = ['Myeloid|NKcells_0', 'NKcells_0|Myeloid', 'Tcells|Tcells']
+
+        all_pairs_pvalues, all_pairs_means, _, _ = \
+            cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(meta, counts, 'ensembl', 10, 0.1, 2,
+                                                                                  0, 3, 0.05)
+        pvalues, means, _, _ = \
+            cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(meta, counts, 'ensembl', 10, 0.1, 2,
+                                                                                  0, 3, 0.05,
+                                                                                  cluster_pairs=cluster_pairs)
+
+        for result, all_pairs_result in ((pvalues, all_pairs_pvalues), (means, all_pairs_means)):
+            self.assertEqual(sorted(cluster_pairs), [column for column in result.columns if '|' in column])
+            self.assertTrue(dataframe_functions.dataframes_has_same_data(
+                result, all_pairs_result[[column for column in all_pairs_result.columns
+                                          if '|' not in column or column in cluster_pairs]]))
+
+    def test_statistical_method__interactions_filter_same_values_as_all_interactions(self):
+        meta = utils.read_data_table_from_file('{}/hi_test_meta.txt'.format(data_test_dir))
+        counts = utils.read_data_table_from_file('{}/hi_test_counts.txt'.format(data_test_dir),
+                                                 index_column_first=True)
+
+        all_pvalues, _, _, _ = \
+            cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(meta, counts, 'ensembl', 10, 0.1, 2,
+                                                                                  0, 3, 0.05)
+
+        interactions = all_pvalues['id_cp_interaction'].iloc[::3].tolist()
+        interactions_filter = {'names': interactions, 'classes': ['secreted', 'integrin']}
+
+        pvalues, _, _, _ = \
+            cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(
+                meta, counts, 'ensembl', 10, 0.1, 2, 0, 3, 0.05, interactions_filter=interactions_filter)
+
+        expected_pvalues = all_pvalues[all_pvalues['id_cp_interaction'].isin(interactions) &
+                                       (all_pvalues['secreted'] | all_pvalues['is_integrin'])]
+
+        self.assertFalse(pvalues.empty)
+        self.assertTrue(dataframe_functions.dataframes_has_same_data(pvalues, expected_pvalues))
+
+    def test_statistical_method__resume_same_result_as_uninterrupted(self):
+        meta = utils.read_data_table_from_file('{}/hi_test_meta.txt'.format(data_test_dir))
+        counts = utils.read_data_table_from_file('{}/hi_test_counts.txt'.format(data_test_dir),
+                                                 index_column_first=True)
+
+        save_checkpoint = cpdb_statistical_analysis_helper.save_checkpoint
+        saved_checkpoints = []
+
+        def interrupted_save_checkpoint(*args):
+            save_checkpoint(*args)
+            saved_checkpoints.append(args[3])
+            if len(saved_checkpoints) == 3:
+                raise KeyboardInterrupt
+
+        def launch(**kwargs):
+            return cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(
+                meta, counts, 'ensembl', 100, 0.1, 2, 0, 3, 0.05, max_exceedances=6, **kwargs)
+
+        uninterrupted_results = launch()
+
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            with mock.patch.object(cpdb_statistical_analysis_helper, 'save_checkpoint', interrupted_save_checkpoint):
+                with self.assertRaises(KeyboardInterrupt):
+                    launch(checkpoint_dir=checkpoint_dir, checkpoint_iterations=10)
+
+                resumed_results = launch(checkpoint_dir=checkpoint_dir, checkpoint_iterations=10, resume=True)
+
+        self.assertEqual([10, 20, 30, 32], saved_checkpoints[:4])
+        for uninterrupted_result, resumed_result in zip(uninterrupted_results, resumed_results):
+            self.assertTrue(dataframe_functions.dataframes_has_same_data(uninterrupted_result, resumed_result))
+
+    def test_checkpoint_fingerprint__depends_on_counts(self):
+        real_mean_analysis = pd.DataFrame([[0.5, 0.0], [1.0, 2.0]])
+        testable = real_mean_analysis.values != 0
+        cells_clusters = np.array([0, 0, 1])
+        counts_matrix = np.array([[0.1, 0.3, 0.5], [0.0, 0.2, 0.4]])
+        interactions_genes_indexes = np.array([0, 1, 1, 0])
+
+        def fingerprint(counts: np.ndarray) -> str:
+            return cpdb_statistical_analysis_helper.get_checkpoint_fingerprint(
+                real_mean_analysis, testable, cells_clusters, counts, interactions_genes_indexes, 100, 32, 0, 0)
+
+        edited_counts_matrix = counts_matrix.copy()
+        edited_counts_matrix[0, 0] = 0.2
+
+        self.assertEqual(fingerprint(counts_matrix), fingerprint(counts_matrix.copy()))
+        self.assertNotEqual(fingerprint(counts_matrix), fingerprint(edited_counts_matrix))
+
+    def test_statistical_method__approximate_pvalues(self):
+        meta = utils.read_data_table_from_file('{}/hi_test_meta.txt'.format(data_test_dir))
+        counts = utils.read_data_table_from_file('{}/hi_test_counts.txt'.format(data_test_dir),
+                                                 index_column_first=True)
+
+        permutation_pvalues, permutation_means, _, _ = \
+            cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(meta.copy(), counts, 'ensembl', 10,
+                                                                                  0.1, 2, 0, 3, 0.05)
+        approximate_pvalues, approximate_means, _, _ = \
+            cellphonedb_app.cellphonedb.method.cpdb_statistical_analysis_launcher(meta.copy(), counts, 'ensembl', 10,
+                                                                                  0.1, 2, 0, 3, 0.05,
+                                                                                  pvalue_method='approximate')
+
+        self.assertTrue(dataframe_functions.dataframes_has_same_data(permutation_means, approximate_means))
+        self.assertEqual(list(permutation_pvalues.columns), list(approximate_pvalues.columns))
+
+        cluster_interactions = [column for column in permutation_pvalues.columns if '|' in column]
+        permutation_values = permutation_pvalues[cluster_interactions].values
+        approximate_values = approximate_pvalues[cluster_interactions].values
+
+        without_mean = permutation_means[cluster_interactions].values == 0
+        self.assertTrue((permutation_values[without_mean] == 1).all())
+        self.assertTrue((approximate_values[without_mean] == 1).all())
+        self.assertTrue(((approximate_values >= 0) & (approximate_values <= 1)).all())
+        self.assertTrue((approximate_values[~without_mean] < 1).any())
+
+    def test_statistical_method__profile_report(self):
+        output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_path)
+
+        LocalMethodLauncher(cellphonedb_app.cellphonedb). \
+            cpdb_statistical_analysis_local_method_launcher('{}/hi_test_meta.txt'.format(data_test_dir),
+                                                            '{}/hi_test_counts.txt'.format(data_test_dir),
+                                                            'ensembl',
+                                                            iterations=10,
+                                                            output_path=output_path,
+                                                            debug_seed=0,
+                                                            threads=2,
+                                                            profile=True)
+
+        with open(os.path.join(output_path, 'profile.json')) as f:
+            profile = json.load(f)
+
+        self.assertEqual(['loading', 'preprocessing', 'prefilters', 'build_clusters', 'real_analysis',
+                          'shuffled_analysis', 'build_results', 'writing'],
+                         [stage['stage'] for stage in profile['stages']])
+        self.assertTrue(all(stage['wall_seconds'] >= 0 for stage in profile['stages']))
+        self.assertEqual(10, profile['dimensions']['iterations'])
+        for dimension in ('cells', 'genes', 'interactions', 'cluster_pairs'):
+            self.assertGreater(profile['dimensions'][dimension], 0)
+
+    def test_complex_prefilters__same_result_as_row_filters(self):
+        counts = utils.read_data_table_from_file('{}/hi_test_counts.txt'.format(data_test_dir),
+                                                 index_column_first=True)
+        database_manager = cellphonedb_app.cellphonedb.database_manager
+        interactions = database_manager.get_repository('interaction').get_all_expanded()
+        genes = database_manager.get_repository('gene').get_all_expanded()
+        complex_composition = database_manager.get_repository('complex').get_all_compositions()
+        complex_expanded = database_manager.get_repository('complex').get_all_expanded()
+
+        interactions_filtered, counts_filtered, complex_in_counts = \
+            cpdb_statistical_analysis_complex_method.prefilters(interactions, counts, genes, complex_expanded,
+                                                                complex_composition, 'ensembl')
+
+        counts_genes = set(counts.index)
+        complex_ids = set(complex_in_counts['complex_multidata_id'])
+        expected_interactions = interactions[[
+            ((not interaction.is_complex_1 and interaction.ensembl_1 in counts_genes) or
+             (not interaction.is_complex_2 and interaction.ensembl_2 in counts_genes)) and
+            (interaction.multidata_1_id in complex_ids or interaction.multidata_2_id in complex_ids)
+            for interaction in interactions.itertuples()]].drop_duplicates('id_cp_interaction')
+
+        self.assertFalse(interactions_filtered.empty)
+        self.assertTrue(interactions_filtered.equals(expected_interactions))
+        self.assertTrue(counts_filtered.index.is_unique)
+        self.assertTrue(set(counts_filtered.index) <= counts_genes)
+
+        analysis_results = cpdb_analysis_complex_method.prefilters(interactions, counts, genes, complex_expanded,
+                                                                   complex_composition, 'ensembl')
+
+        for result, analysis_result in zip((interactions_filtered, counts_filtered, complex_in_counts),
+                                           analysis_results):
+            self.assertTrue(result.equals(analysis_result))
+
+    def test_interactions_genes_indexes__missing_gene_raises(self):
+        interactions = pd.DataFrame({'ensembl_1': ['ensembl2', 'ensembl2'], 'ensembl_2': ['ensembl1', 'ensembl4']})
+        genes = pd.Index(['ensembl1', 'ensembl2', 'ensembl3'])
+
+        receptor_genes, ligand_genes = cpdb_statistical_analysis_helper.get_interactions_genes_indexes(
+            interactions.iloc[:1], genes)
+        self.assertEqual([1], receptor_genes.tolist())
+        self.assertEqual([0], ligand_genes.tolist())
+
+        with self.assertRaisesRegex(KeyError, 'ensembl4'):
+            cpdb_statistical_analysis_helper.get_interactions_genes_indexes(interactions, genes)
+
+    def test_interactions_processed__missing_complex_raises(self):
+        interactions = pd.DataFrame({'ensembl_1': ['ensembla', None], 'ensembl_2': [None, 'ensemblb'],
+                                     'name_1': ['uniprota', 'complex2'], 'name_2': ['complex1', 'uniprotb'],
+                                     'is_complex_1': [False, True], 'is_complex_2': [True, False]})
+        complex_significative_gene = pd.Series(['ensemblw'], index=['complex1'])
+
+        for method in (cpdb_statistical_analysis_complex_method, cpdb_analysis_complex_method):
+            processed_interactions = method.get_interactions_processed(interactions.iloc[:1],
+                                                                       complex_significative_gene)
+            self.assertEqual(['ensembla', 'ensemblw'], processed_interactions.iloc[0].tolist())
+
+            with self.assertRaisesRegex(KeyError, 'complex2'):
+                method.get_interactions_processed(interactions, complex_significative_gene)
+
     def _method_call(self,
                      data: str,
                      iterations: int,
@@ -71,7 +322,8 @@ class TestTerminalMethodStatisticalAnalysis(CellphoneFlaskTestCase):
                      debug_seed: int,
                      result_precision: int,
                      subsampler: Optional[Subsampler] = None,
-                     counts_data: str = 'ensembl'
+                     counts_data: str = 'ensembl',
+                     counts_format: str = 'txt'
                      ):
 
         result_names_as_fixture = False
@@ -99,6 +351,11 @@ class TestTerminalMethodStatisticalAnalysis(CellphoneFlaskTestCase):
 
         counts_filename = os.path.realpath(counts_file)
 
+        if counts_format != 'txt':
+            sparse_counts_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, sparse_counts_dir)
+            counts_filename = self.write_sparse_counts(counts_filename, counts_format, sparse_counts_dir)
+
         LocalMethodLauncher(cellphonedb_app.cellphonedb). \
             cpdb_statistical_analysis_local_method_launcher(meta_filename,
                                                             counts_filename,
@@ -1,5 +1,11 @@
+import os
+import shutil
+import tempfile
+
 from flask_testing import TestCase
 
+from cellphonedb.src.app import cpdb_app
+from cellphonedb.src.app.cellphonedb_app import core_dir
 from cellphonedb.src.app.flask.flask_app import create_app
 
 
@@ -9,3 +15,22 @@ class TestDatabase(TestCase):
 
     def test_database_init(self):
         pass
+
+    def test_database_cache(self):
+        database_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, database_dir)
+        database_file = os.path.join(database_dir, 'cellphone.db')
+        shutil.copy(os.path.join(core_dir, 'cellphone.db'), database_file)
+
+        uncached_manager = cpdb_app.create_app(database_file=database_file).database_manager
+        uncached_manager.cache = None
+        expected_interactions = uncached_manager.get_repository('interaction').get_all_expanded()
+        expected_genes = uncached_manager.get_repository('gene').get_all_expanded()
+
+        cached_manager = cpdb_app.create_app(database_file=database_file).database_manager
+        cached_manager.get_repository('interaction').get_all_expanded()
+        self.assertTrue(os.path.isfile(cached_manager.cache.cache_file))
+
+        database_manager = cpdb_app.create_app(database_file=database_file).database_manager
+        self.assertTrue(database_manager.get_repository('interaction').get_all_expanded().equals(expected_interactions))
+        self.assertTrue(database_manager.get_repository('gene').get_all_expanded().equals(expected_genes))
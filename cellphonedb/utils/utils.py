@@ -1,21 +1,33 @@
 import io
 import os
 import pickle
-from typing import TextIO, Optional
+from typing import TextIO, Optional, Iterator, Union
 
 import pandas as pd
+from scipy import sparse
+from scipy.io import mmread
 from werkzeug.datastructures import FileStorage
 
 from cellphonedb.src.app.app_logger import app_logger
 from cellphonedb.src.app.cellphonedb_app import output_dir
 
+from cellphonedb.src.core.utils.sparse_counts import SparseCounts
 from cellphonedb.src.exceptions.NotADataFrameException import NotADataFrameException
+from cellphonedb.src.exceptions.ParseCountsException import ParseCountsException
 from cellphonedb.src.exceptions.ReadFileException import ReadFileException
 from cellphonedb.src.exceptions.ReadFromPickleException import ReadFromPickleException
 
 
+COLUMNAR_EXTENSIONS = ['.parquet', '.feather']
+
+
 def read_data_table_from_file(file: str, index_column_first: bool = False, separator: str = '',
-                              dtype=None, na_values=None, compression=None) -> pd.DataFrame:
+                              dtype=None, na_values=None, compression=None, index_filter: Optional[list] = None,
+                              chunksize: int = 1000) -> pd.DataFrame:
+    """
+    Reads a table file. If index_filter is set, the file is read in chunks of chunksize rows and only the rows with
+    the index in index_filter are kept, so the memory used depends on the selected rows instead of the file size.
+    """
     filename, file_extension = os.path.splitext(file)
 
     if file_extension == '.pickle':
@@ -23,7 +35,7 @@ def read_data_table_from_file(file: str, index_column_first: bool = False, separ
             with open(file, 'rb') as f:
                 df = pickle.load(f)
                 if isinstance(df, pd.DataFrame):
-                    return df
+                    return df if index_filter is None else df[df.index.isin(index_filter)]
                 else:
                     raise NotADataFrameException(file)
         except:
@@ -37,7 +49,114 @@ def read_data_table_from_file(file: str, index_column_first: bool = False, separ
         raise ReadFileException(file)
     else:
         with f:
-            return _read_data(f, separator, index_column_first, dtype, na_values, compression)
+            return _read_data(f, separator, index_column_first, dtype, na_values, compression, index_filter,
+                              chunksize)
+
+
+def read_counts_chunks_from_file(file: str, counts_data: str = 'ensembl', chunksize: int = 1000) -> Iterator[
+        Union[pd.DataFrame, SparseCounts]]:
+    """
+    Reads a genes x cells counts file in chunks of chunksize genes. Delimited text files are streamed, so only one
+    chunk is in memory; sparse and pickle files are loaded and split.
+    """
+    if is_sparse_counts_file(file):
+        counts = read_sparse_counts_from_file(file, counts_data)
+        for start in range(0, counts.shape[0], chunksize):
+            yield SparseCounts(counts.matrix[start:start + chunksize], counts.index[start:start + chunksize],
+                               counts.columns)
+        return
+
+    _, file_extension = os.path.splitext(file)
+
+    if file_extension == '.pickle':
+        counts = read_data_table_from_file(file, index_column_first=True)
+        for start in range(0, len(counts), chunksize):
+            yield counts.iloc[start:start + chunksize]
+        return
+
+    try:
+        f = open(file)
+    except Exception:
+        raise ReadFileException(file)
+    else:
+        with f:
+            for chunk in pd.read_csv(f, sep=_get_separator(file_extension), index_col=0, chunksize=chunksize):
+                yield chunk
+
+
+def is_sparse_counts_file(file: str) -> bool:
+    return file.endswith(('.mtx', '.mtx.gz', '.h5', '.npz'))
+
+
+def read_sparse_counts_from_file(file: str, counts_data: str = 'ensembl') -> SparseCounts:
+    """
+    Reads a genes x cells sparse counts matrix:
+     - Matrix Market (.mtx or .mtx.gz) or scipy (.npz) matrix, with the barcodes.tsv and features.tsv (or genes.tsv)
+       files in the same directory, as written by 10x Cell Ranger.
+     - 10x Cell Ranger HDF5 (.h5). It requires h5py.
+
+    The gene ids are taken from the first features column for ensembl counts data and from the second one otherwise.
+    """
+    try:
+        if file.endswith('.h5'):
+            return _read_10x_h5(file, counts_data)
+
+        if file.endswith('.npz'):
+            matrix = sparse.load_npz(file)
+        else:
+            matrix = mmread(file)
+    except ParseCountsException:
+        raise
+    except Exception:
+        raise ReadFileException(file)
+
+    directory = os.path.dirname(file)
+    barcodes = _read_sparse_labels(directory, ['barcodes.tsv', 'barcodes.tsv.gz'])
+    features = _read_sparse_labels(directory, ['features.tsv', 'features.tsv.gz', 'genes.tsv', 'genes.tsv.gz'])
+
+    return SparseCounts(matrix, _select_features_column(features, counts_data), barcodes.iloc[:, 0])
+
+
+def _read_sparse_labels(directory: str, filenames: list) -> pd.DataFrame:
+    for filename in filenames:
+        file = os.path.join(directory, filename)
+        if os.path.exists(file):
+            return pd.read_csv(file, sep='\t', header=None, dtype=str)
+
+    raise ParseCountsException('Missing {} file for the sparse counts matrix'.format(filenames[0]),
+                               'It must be in the same directory as the counts matrix')
+
+
+def _select_features_column(features: pd.DataFrame, counts_data: str) -> pd.Series:
+    if counts_data == 'ensembl' or features.shape[1] < 2:
+        return features.iloc[:, 0]
+
+    return features.iloc[:, 1]
+
+
+def _read_10x_h5(file: str, counts_data: str) -> SparseCounts:
+    try:
+        import h5py
+    except ImportError:
+        raise ParseCountsException('h5py is required to read 10x HDF5 counts',
+                                   'Install it with `pip install cellphonedb[h5]`')
+
+    with h5py.File(file, 'r') as f:
+        if 'matrix' in f:
+            group = f['matrix']
+            features = pd.DataFrame({0: group['features/id'][:], 1: group['features/name'][:]})
+        else:
+            group = f[list(f.keys())[0]]
+            features = pd.DataFrame({0: group['genes'][:], 1: group['gene_names'][:]})
+
+        matrix = sparse.csc_matrix((group['data'][:], group['indices'][:], group['indptr'][:]),
+                                   shape=group['shape'][:])
+        barcodes = group['barcodes'][:]
+
+    features = features.applymap(lambda value: value.decode() if isinstance(value, bytes) else value)
+    barcodes = [barcode.decode() if isinstance(barcode, bytes) else barcode for barcode in barcodes]
+
+    return SparseCounts(matrix, _select_features_column(features, counts_data), barcodes)
 
 
 def read_data_from_content_type(file: FileStorage, index_column_first: bool = False, separator: str = '',
@@ -57,7 +176,12 @@ def read_data_from_s3_object(s3_object: dict, s3_name: str, index_column_first:
     return _read_data(bytestream, separator, index_column_first, dtype, na_values)
 
 
-def write_to_file(df: pd.DataFrame, filename: str, output_path: str, output_format: Optional[str] = None):
+def write_to_file(df: pd.DataFrame, filename: str, output_path: str, output_format: Optional[str] = None,
+                  compression: Optional[str] = None):
+    """
+    Writes the table as delimited text or, for parquet and feather formats, as a columnar file with float32 values.
+    Compression (snappy, gzip or brotli) is only applied to parquet files.
+    """
     _, file_extension = os.path.splitext(filename)
 
     if output_format is None:
@@ -65,15 +189,15 @@ def write_to_file(df: pd.DataFrame, filename: str, output_path: str, output_form
             default_format = 'txt'
             default_extension = '.{}'.format(default_format)
 
-            separator = _get_separator(default_extension)
+            extension = default_extension
             filename = '{}{}'.format(filename, default_extension)
         else:
-            separator = _get_separator(file_extension)
+            extension = file_extension
     else:
         selected_extension = '.{}'.format(output_format)
 
         if file_extension != selected_extension:
-            separator = _get_separator(selected_extension)
+            extension = selected_extension
             filename = '{}{}'.format(filename, selected_extension)
 
             if file_extension:
@@ -81,15 +205,50 @@ def write_to_file(df: pd.DataFrame, filename: str, output_path: str, output_form
                     'Selected extension missmatches output filename ({}, {}): It will be added => {}'.format(
                         selected_extension, file_extension, filename))
         else:
-            separator = _get_separator(selected_extension)
+            extension = selected_extension
 
-    df.to_csv('{}/{}'.format(output_path, filename), sep=separator, index=False)
+    file = '{}/{}'.format(output_path, filename)
+
+    if extension.lower() in COLUMNAR_EXTENSIONS:
+        _write_columnar_data(df, file, extension, compression)
+    else:
+        df.to_csv(file, sep=_get_separator(extension), index=False)
+
+
+def data_to_bytes(df: pd.DataFrame, file_extension: str, compression: Optional[str] = None) -> bytes:
+    if file_extension.lower() not in COLUMNAR_EXTENSIONS:
+        return df.to_csv(sep=_get_separator(file_extension), index=False).encode('utf-8')
+
+    buffer = io.BytesIO()
+    _write_columnar_data(df, buffer, file_extension, compression)
+
+    return buffer.getvalue()
+
+
+def _write_columnar_data(df: pd.DataFrame, file, file_extension: str, compression: Optional[str] = None):
+    columnar_data = df.reset_index(drop=True)
+    columnar_data = columnar_data.astype(
+        {column: 'float32' for column in columnar_data.select_dtypes(include=['float64']).columns})
+
+    if file_extension.lower() == '.parquet':
+        columnar_data.to_parquet(file, compression=compression)
+    else:
+        if compression:
+            app_logger.warning('Compression is not available for feather files: {} ignored'.format(compression))
+        columnar_data.to_feather(file)
 
 
 def _read_data(file_stream: TextIO, separator: str, index_column_first: bool, dtype=None,
-               na_values=None, compression=None) -> pd.DataFrame:
-    return pd.read_csv(file_stream, sep=separator, index_col=0 if index_column_first else None, dtype=dtype,
-                       na_values=na_values, compression=compression)
+               na_values=None, compression=None, index_filter: Optional[list] = None,
+               chunksize: int = 1000) -> pd.DataFrame:
+    if index_filter is None:
+        return pd.read_csv(file_stream, sep=separator, index_col=0 if index_column_first else None, dtype=dtype,
+                           na_values=na_values, compression=compression)
+
+    chunks = pd.read_csv(file_stream, sep=separator, index_col=0 if index_column_first else None, dtype=dtype,
+                         na_values=na_values, compression=compression, chunksize=chunksize)
+
+    return pd.concat([chunk[chunk.index.isin(index_filter)] for chunk in chunks])
 
 
 def _get_separator(mime_type_or_extension: str) -> str:
@@ -1,16 +1,16 @@
 #!/usr/bin/env python
 
-import io
 import json
 import os
 import sys
+import queue
 import tempfile
-import time
+import threading
 import traceback
 from distutils.util import strtobool
-from functools import wraps
+from functools import partial, wraps
 from logging import INFO
-from typing import Callable
+from typing import Callable, Optional
 
 import boto3
 import pandas as pd
@@ -18,6 +18,7 @@ import pika
 
 from cellphonedb.src.app import cpdb_app
 from cellphonedb.src.core.exceptions.AllCountsFilteredException import AllCountsFilteredException
+from cellphonedb.src.core.exceptions.ClusterPairsException import ClusterPairsException
 from cellphonedb.src.core.exceptions.EmptyResultException import EmptyResultException
 from cellphonedb.src.core.exceptions.ThresholdValueException import ThresholdValueException
 from cellphonedb.src.core.utils.subsampler import Subsampler
@@ -52,6 +53,13 @@ except KeyError as e:
 
 verbose = bool(strtobool(os.getenv('VERBOSE', 'true')))
 
+# MAX_JOBS=0 keeps the worker consuming jobs until it is stopped
+max_jobs = int(os.getenv('MAX_JOBS', '3'))
+rabbit_prefetch = int(os.getenv('RABBIT_PREFETCH', '1'))
+rabbit_heartbeat = int(os.getenv('RABBIT_HEARTBEAT', '60'))
+
+apps = {}
+
 if verbose:
     rabbit_logger.setLevel(INFO)
 
@@ -78,10 +86,23 @@ def create_rabbit_connection():
         host=rabbit_host,
         port=rabbit_port,
         virtual_host='/',
-        credentials=credentials
+        credentials=credentials,
+        heartbeat=rabbit_heartbeat
     ))
 
 
+def get_app(database_version: str):
+    """
+    Returns the app of the database version, created once and reused by the following jobs
+    """
+    database_file = find_database_for(database_version)
+
+    if database_file not in apps:
+        apps[database_file] = cpdb_app.create_app(verbose=verbose, database_file=database_file)
+
+    return apps[database_file]
+
+
 s3_resource = boto3.resource('s3', aws_access_key_id=s3_access_key,
                              aws_secret_access_key=s3_secret_key,
                              endpoint_url=s3_endpoint)
@@ -96,28 +117,16 @@ def read_data_from_s3(filename: str, s3_bucket_name: str, index_column_first: bo
     return utils.read_data_from_s3_object(s3_object, filename, index_column_first=index_column_first)
 
 
-def write_data_in_s3(data: pd.DataFrame, filename: str):
-    result_buffer = io.StringIO()
-    data.to_csv(result_buffer, index=False, sep='\t')
-    result_buffer.seek(0)
+def write_data_in_s3(data: pd.DataFrame, filename: str, compression: Optional[str] = None):
+    _, file_extension = os.path.splitext(filename)
+    result = utils.data_to_bytes(data, file_extension, compression)
 
-    # TODO: Find more elegant solution (connexion closes after timeout)
-    s3_client = boto3.client('s3', aws_access_key_id=s3_access_key,
-                             aws_secret_access_key=s3_secret_key,
-                             endpoint_url=s3_endpoint)
-
-    s3_client.put_object(Body=result_buffer.getvalue().encode('utf-8'), Bucket=s3_bucket_name, Key=filename)
+    s3_client.put_object(Body=result, Bucket=s3_bucket_name, Key=filename)
 
 
 def write_image_to_s3(path: str, filename: str):
-    _io = open(path, 'rb')
-
-    # TODO: Find more elegant solution (connexion closes after timeout)
-    s3_client = boto3.client('s3', aws_access_key_id=s3_access_key,
-                             aws_secret_access_key=s3_secret_key,
-                             endpoint_url=s3_endpoint)
-
-    s3_client.put_object(Body=_io, Bucket=s3_bucket_name, Key=filename)
+    with open(path, 'rb') as _io:
+        s3_client.put_object(Body=_io, Bucket=s3_bucket_name, Key=filename)
 
 
 @_track_success
@@ -271,7 +280,7 @@ def process_method(method, properties, body, logger) -> dict:
     if database_version not in list_local_versions() + ['latest']:
         database_version = 'latest'
 
-    app = cpdb_app.create_app(verbose=verbose, database_file=find_database_for(database_version))
+    app = get_app(database_version)
 
     if metadata['iterations']:
         response = statistical_analysis(app, meta, counts, job_id, metadata, subsampler)
@@ -281,6 +290,16 @@ def process_method(method, properties, body, logger) -> dict:
     return response
 
 
+def get_interactions_filter(metadata: dict) -> Optional[dict]:
+    interactions_filter = {'names': metadata.get('interactions', None),
+                           'classes': metadata.get('interaction_classes', None)}
+
+    if not any(interactions_filter.values()):
+        return None
+
+    return interactions_filter
+
+
 @_track_success
 def statistical_analysis(app, meta, counts, job_id, metadata, subsampler):
     pvalues, means, significant_means, deconvoluted = \
@@ -294,21 +313,27 @@ def statistical_analysis(app, meta, counts, job_id, metadata, subsampler):
                                                       result_precision=int(metadata['result_precision']),
                                                       pvalue=float(metadata.get('pvalue', 0.05)),
                                                       subsampler=subsampler,
+                                                      max_exceedances=int(metadata.get('max_exceedances', 0)),
+                                                      cell_types=metadata.get('cell_types', None),
+                                                      cluster_pairs=metadata.get('cluster_pairs', None),
+                                                      interactions_filter=get_interactions_filter(metadata),
                                                       )
+    output_format = metadata.get('output_format', 'txt')
+    output_compression = metadata.get('output_compression', None)
     response = {
         'job_id': job_id,
         'files': {
-            'pvalues': 'pvalues_simple_{}.txt'.format(job_id),
-            'means': 'means_simple_{}.txt'.format(job_id),
-            'significant_means': 'significant_means_simple_{}.txt'.format(job_id),
-            'deconvoluted': 'deconvoluted_simple_{}.txt'.format(job_id),
+            'pvalues': 'pvalues_simple_{}.{}'.format(job_id, output_format),
+            'means': 'means_simple_{}.{}'.format(job_id, output_format),
+            'significant_means': 'significant_means_simple_{}.{}'.format(job_id, output_format),
+            'deconvoluted': 'deconvoluted_simple_{}.{}'.format(job_id, output_format),
         },
         'success': True
     }
-    write_data_in_s3(pvalues, response['files']['pvalues'])
-    write_data_in_s3(means, response['files']['means'])
-    write_data_in_s3(significant_means, response['files']['significant_means'])
-    write_data_in_s3(deconvoluted, response['files']['deconvoluted'])
+    write_data_in_s3(pvalues, response['files']['pvalues'], output_compression)
+    write_data_in_s3(means, response['files']['means'], output_compression)
+    write_data_in_s3(significant_means, response['files']['significant_means'], output_compression)
+    write_data_in_s3(deconvoluted, response['files']['deconvoluted'], output_compression)
     return response
 
 
@@ -321,93 +346,107 @@ def non_statistical_analysis(app, meta, counts, job_id, metadata, subsampler):
                                                  threshold=float(metadata['threshold']),
                                                  result_precision=int(metadata['result_precision']),
                                                  subsampler=subsampler,
+                                                 cell_types=metadata.get('cell_types', None),
+                                                 cluster_pairs=metadata.get('cluster_pairs', None),
+                                                 interactions_filter=get_interactions_filter(metadata),
                                                  )
+    output_format = metadata.get('output_format', 'txt')
+    output_compression = metadata.get('output_compression', None)
     response = {
         'job_id': job_id,
         'files': {
-            'means': 'means_simple_{}.txt'.format(job_id),
-            'significant_means': 'significant_means_{}.txt'.format(job_id),
-            'deconvoluted': 'deconvoluted_simple_{}.txt'.format(job_id),
+            'means': 'means_simple_{}.{}'.format(job_id, output_format),
+            'significant_means': 'significant_means_{}.{}'.format(job_id, output_format),
+            'deconvoluted': 'deconvoluted_simple_{}.{}'.format(job_id, output_format),
         },
         'success': True
     }
-    write_data_in_s3(means, response['files']['means'])
-    write_data_in_s3(significant_means, response['files']['significant_means'])
-    write_data_in_s3(deconvoluted, response['files']['deconvoluted'])
+    write_data_in_s3(means, response['files']['means'], output_compression)
+    write_data_in_s3(significant_means, response['files']['significant_means'], output_compression)
+    write_data_in_s3(deconvoluted, response['files']['deconvoluted'], output_compression)
     return response
 
 
-consume_more_jobs = True
+def process_job(method, properties, body) -> dict:
+    job_id = json.loads(body.decode('utf-8'))['job_id']
+    job_logger = logger_for_job(job_id)
+    try:
+        if queue_type == 'plot':
+            job_response = process_plot(method, properties, body, logger=job_logger)
+        elif queue_type == 'method':
+            job_response = process_method(method, properties, body, logger=job_logger)
+        else:
+            raise Exception('Unknown queue type')
+
+        job_logger.info('JOB PROCESSED')
+        return job_response
+    except (ReadFileException, ParseMetaException, ParseCountsException, ThresholdValueException,
+            AllCountsFilteredException, EmptyResultException, PlotException, ClusterPairsException) as e:
+        error_response = {
+            'job_id': job_id,
+            'success': False,
+            'error': {
+                'id': str(e),
+                'message': (' {}.'.format(e.description) if hasattr(e, 'description') and e.description else '') +
+                           (' {}.'.format(e.hint) if hasattr(e, 'hint') and e.hint else '')
+
+            }
+        }
+        print(traceback.print_exc(file=sys.stdout))
+        job_logger.error('[-] ERROR DURING PROCESSING JOB')
+        job_logger.error(e)
+        return error_response
+    except Exception as e:
+        error_response = {
+            'job_id': job_id,
+            'success': False,
+            'error': {
+                'id': 'unknown_error',
+                'message': ''
+            }
+        }
+        print(traceback.print_exc(file=sys.stdout))
+        job_logger.error('[-] ERROR DURING PROCESSING JOB')
+        job_logger.error(e)
+        return error_response
+
+
+def publish_response(channel, delivery_tag: int, job_response: dict):
+    channel.basic_publish(exchange='', routing_key=result_queue_name, body=json.dumps(job_response))
+    channel.basic_ack(delivery_tag=delivery_tag)
+
+
+def jobs_worker(connection, channel, jobs: queue.Queue):
+    """
+    Processes the received jobs one by one, out of the connection thread so the heartbeats are answered while a job
+    runs. Publishing and acknowledging are sent back to the connection thread.
+    """
+    jobs_runned = 0
+
+    while not max_jobs or jobs_runned < max_jobs:
+        method, properties, body = jobs.get()
+
+        job_response = process_job(method, properties, body)
+        connection.add_callback_threadsafe(partial(publish_response, channel, method.delivery_tag, job_response))
+
+        jobs_runned += 1
+
+    connection.add_callback_threadsafe(channel.stop_consuming)
+
 
 credentials = pika.PlainCredentials(rabbit_user, rabbit_password)
 connection = create_rabbit_connection()
 channel = connection.channel()
-channel.basic_qos(prefetch_count=1)
-
-jobs_runned = 0
-
-while jobs_runned < 3 and consume_more_jobs:
-    job = channel.basic_get(queue=jobs_queue_name, no_ack=True)
-
-    if all(job):
-        job_id = json.loads(job[2].decode('utf-8'))['job_id']
-        job_logger = logger_for_job(job_id)
-        try:
-            if queue_type == 'plot':
-                job_response = process_plot(*job, logger=job_logger)
-            elif queue_type == 'method':
-                job_response = process_method(*job, logger=job_logger)
-            else:
-                raise Exception('Unknown queue type')
-
-            # TODO: Find more elegant solution
-            connection = create_rabbit_connection()
-            channel = connection.channel()
-            channel.basic_qos(prefetch_count=1)
-
-            channel.basic_publish(exchange='', routing_key=result_queue_name, body=json.dumps(job_response))
-            job_logger.info('JOB PROCESSED')
-        except (ReadFileException, ParseMetaException, ParseCountsException, ThresholdValueException,
-                AllCountsFilteredException, EmptyResultException, PlotException) as e:
-            error_response = {
-                'job_id': job_id,
-                'success': False,
-                'error': {
-                    'id': str(e),
-                    'message': (' {}.'.format(e.description) if hasattr(e, 'description') and e.description else '') +
-                               (' {}.'.format(e.hint) if hasattr(e, 'hint') and e.hint else '')
+channel.basic_qos(prefetch_count=rabbit_prefetch)
 
-                }
-            }
-            print(traceback.print_exc(file=sys.stdout))
-            job_logger.error('[-] ERROR DURING PROCESSING JOB')
-            if connection.is_closed:
-                connection = create_rabbit_connection()
-                channel = connection.channel()
-                channel.basic_qos(prefetch_count=1)
-            channel.basic_publish(exchange='', routing_key=result_queue_name, body=json.dumps(error_response))
-            job_logger.error(e)
-        except Exception as e:
-            error_response = {
-                'job_id': job_id,
-                'success': False,
-                'error': {
-                    'id': 'unknown_error',
-                    'message': ''
-                }
-            }
-            print(traceback.print_exc(file=sys.stdout))
-            job_logger.error('[-] ERROR DURING PROCESSING JOB')
-            if connection.is_closed:
-                connection = create_rabbit_connection()
-                channel = connection.channel()
-                channel.basic_qos(prefetch_count=1)
-            channel.basic_publish(exchange='', routing_key=result_queue_name, body=json.dumps(error_response))
-            job_logger.error(e)
+received_jobs = queue.Queue()
 
-        jobs_runned += 1
+channel.basic_consume(lambda _channel, method, properties, body: received_jobs.put((method, properties, body)),
+                      queue=jobs_queue_name,
+                      no_ack=False)
 
-    else:
-        rabbit_logger.debug('Empty queue')
+worker = threading.Thread(target=jobs_worker, args=(connection, channel, received_jobs), daemon=True)
+worker.start()
 
-    time.sleep(1)
+channel.start_consuming()
+connection.close()
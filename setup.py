@@ -22,7 +22,9 @@ setup(
     },
     install_requires=[
         'click>=6.7,<6.7.99',
+        'numpy>=1.18,<1.18.99',
         'pandas>=0.23,<0.23.99',
+        'scipy>=1.1,<1.1.99',
         'flask>=1.0,<1.0.99',
         'Flask-RESTful>=0.3,<0.3.99',
         'Flask-Testing>=0.7,<0.7.99',
@@ -35,4 +37,8 @@ setup(
         'rpy2>=3.0.4,<3.0.99',
         'tqdm>=4.32,<4.32.99',
     ],
+    extras_require={
+        'h5': ['h5py>=2.9,<2.9.99'],
+        'columnar': ['pyarrow>=0.13,<0.13.99', 'feather-format>=0.4,<0.4.99'],
+    },
 )